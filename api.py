@@ -1,10 +1,12 @@
 import os
 from datetime import datetime
 from flask import Flask, request, jsonify
+from a2wsgi import WSGIMiddleware
 # functions and controllers
-from controllers.auth import require_api_key, require_admin, api_key_manager
+from controllers.auth import require_api_key, require_admin, api_key_manager, log_operation
 from controllers.functions import (
     chat_handler, 
+    chat_stream_handler, 
     manage_collection_handler, 
     get_collections_handler,
     get_collection_info_handler,
@@ -24,7 +26,12 @@ app = Flask(__name__)
 # environment and api variables
 API_KEY_HOST = os.getenv('API_KEY_HOST', '0.0.0.0')
 API_KEY_PORT = int(os.getenv('API_KEY_PORT', 5000))
-API_LOG_FILE = os.getenv('API_LOG_FILE', 'log.txt')
+# production server: uvicorn processes, threads per process for the
+# flask requests, and seconds to finish the requests on shutdown
+API_WORKERS = int(os.getenv('API_WORKERS', os.cpu_count() or 1))
+API_THREADS = int(os.getenv('API_THREADS', 64))
+API_GRACEFUL_TIMEOUT = int(os.getenv('API_GRACEFUL_TIMEOUT', 30))
+API_PID_FILE = os.getenv('API_PID_FILE', 'api.pid')
 
 # check that the request comes in json
 def validate_json_request():
@@ -76,6 +83,17 @@ def chat():
     
     return chat_handler(data, request.user_email)
 
+@app.route('/chat/stream', methods=['POST'])
+@require_api_key
+@handle_request_error
+def chat_stream():
+    """Endpoint para chat con colección, la respuesta llega en streaming (SSE)"""
+    data, error = validate_json_request()
+    if error:
+        return jsonify(error[0]), error[1]
+    
+    return chat_stream_handler(data, request.user_email)
+
 
 ## falta embeddings
 
@@ -131,6 +149,7 @@ def get_embeddings():
     return get_embeddings_handler()
 
 @app.route('/settings', methods=['GET'])
+@require_api_key
 @handle_request_error
 def get_settings():
     """Endpoint para obtener configuración de colección"""
@@ -198,14 +217,35 @@ def internal_error(error):
 ################################# API Running ###########################
 #########################################################################
 
+# asgi app served by uvicorn, every worker runs the flask requests on
+# its own pool of API_THREADS threads, so slow llm calls do not block
+# the rest
+asgi_app = WSGIMiddleware(app, workers=API_THREADS)
+
+def serve():
+    """Corre la API con uvicorn, en API_WORKERS procesos"""
+    import uvicorn
+    # ker stop sends SIGTERM to this pid, uvicorn stops taking requests
+    # and waits up to API_GRACEFUL_TIMEOUT for the ones in progress.
+    # ker run already wrote it, this covers running api.py directly
+    with open(API_PID_FILE, 'w') as f:
+        f.write(str(os.getpid()))
+    try:
+        uvicorn.run(
+            "api:asgi_app",
+            host=API_KEY_HOST,
+            port=API_KEY_PORT,
+            workers=API_WORKERS,
+            timeout_graceful_shutdown=API_GRACEFUL_TIMEOUT,
+            app_dir=os.path.dirname(os.path.abspath(__file__))
+        )
+    finally:
+        if os.path.exists(API_PID_FILE):
+            os.remove(API_PID_FILE)
+
 if __name__ == '__main__':
-    # Crear archivos iniciales si no existen
-    if not os.path.exists(API_LOG_FILE):
-        try:
-            with open(API_LOG_FILE, 'w') as f:
-                f.write(f"API Log initialized at {datetime.now().isoformat()}\n")
-        except Exception as e:
-            print(f"Warning: Could not create log file: {e}")
+    # Registrar el inicio en el log
+    log_operation("system", "API_START", {'workers': API_WORKERS, 'threads': API_THREADS}, f"{API_KEY_HOST}:{API_KEY_PORT}")
     
     # Crear directorio controllers si no existe
     if not os.path.exists('controllers'):
@@ -226,4 +266,8 @@ if __name__ == '__main__':
         print(f"Warning: Could not generate initial API key: {e}")
     
     print(f"Starting API server on {API_KEY_HOST}:{API_KEY_PORT}")
-    app.run(debug=True, host=API_KEY_HOST, port=API_KEY_PORT)
\ No newline at end of file
+    # API_DEBUG=1 for the flask development server, with the reloader
+    if os.getenv('API_DEBUG') == '1':
+        app.run(debug=True, host=API_KEY_HOST, port=API_KEY_PORT)
+    else:
+        serve()
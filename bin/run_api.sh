@@ -1,10 +1,10 @@
 #!/bin/bash
 
-# NOTE: THIS FILE IS EXECUTED BY KER FILE
+# NOTE: ker run starts the api on the background, this file runs it on
+# the foreground (for systemd, docker...) with the env loaded by ker
 
 # a message
-echo \nRunning sdb_$1\n
+echo -e "\nRunning the API on $API_KEY_HOST:$API_KEY_PORT\n"
 
-# open a tmux session: activate the venv and run the api
-# also name it as the sdb instance name
-tmux new-session -d -s "sdb_$1" "source $PROJECT_PATH/venv/bin/activate python3 $PROJECT_PATH/api.py $1"
\ No newline at end of file
+# run it from the project dir, the api files are relative to it
+cd "$PROJECT_PATH" && exec python3 "$PROJECT_PATH/api.py"
@@ -1,14 +1,24 @@
 #!/bin/bash
 
-# NOTE: THIS FILE IS EXECUTED BY KER FILE
+# NOTE: same as ker stop, the api finishes the requests in progress
 
-# kill the tmux session
-tmux kill-session -t "sdb_$1"
+# the api writes its pid when it starts
+PID_FILE="$PROJECT_PATH/${API_PID_FILE:-api.pid}"
+
+if [ ! -f "$PID_FILE" ]; then
+    echo -e "\nAPI is not running\n"
+    exit 0
+fi
 
 # a message
-echo \nStoppig sdb_$1\n
+echo -e "\nStopping the API\n"
 
-# show the active sessions
-tmux ls
+# to the whole process group, so the uvicorn workers stop too
+PID="$(cat "$PID_FILE")"
+if [ "$(ps -o pgid= -p "$PID" | tr -d ' ')" = "$PID" ]; then
+    kill -TERM -- "-$PID"
+else
+    kill -TERM "$PID"
+fi
 
-exit 0
\ No newline at end of file
+exit 0
@@ -1,10 +1,16 @@
 import os
 import json
+import time
+import fcntl
+import atexit
 import hashlib
 import secrets
+import threading
 from datetime import datetime
 from functools import wraps
+from contextlib import contextmanager
 from flask import request, jsonify
+from .logs import log_writer
 
 #########################################################################
 ######################### Globals #######################################
@@ -13,20 +19,23 @@ from flask import request, jsonify
 # Configuración desde variables de entorno
 API_KEYS_FILE = os.getenv('API_KEYS_FILE', '.apikeys')
 API_KEY_LENGTH = int(os.getenv('API_KEY_LENGTH', 64))
+API_KEYS_FLUSH_SECONDS = float(os.getenv('API_KEYS_FLUSH_SECONDS', 30))
+API_KEYS_CHECK_SECONDS = float(os.getenv('API_KEYS_CHECK_SECONDS', 2))
 ADMINS_FILE = os.getenv('ADMINS_FILE', '.admins')
-API_LOG_FILE = os.getenv('API_LOG_FILE', 'log.txt')
+ADMINS_CHECK_SECONDS = float(os.getenv('ADMINS_CHECK_SECONDS', 2))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 5))
 
 
 #########################################################################
 ######################### Admins ########################################
 #########################################################################
 
-def get_admin_emails():
-    """Carga la lista de emails de administradores desde el archivo"""
+def read_admin_emails():
+    """Lee la lista de emails de administradores desde el archivo"""
     try:
         if os.path.exists(ADMINS_FILE):
             with open(ADMINS_FILE, 'r') as f:
-                emails = [line.strip() for line in f.readlines() if line.strip()]
+                emails = [line.strip().lower() for line in f.readlines() if line.strip()]
                 return emails
         else:
             print(f"Warning: Admin emails file '{ADMINS_FILE}' not found")
@@ -35,6 +44,74 @@ def get_admin_emails():
         print(f"Error loading admin emails: {e}")
         return []
 
+class AdminList:
+    """Lista de admins en memoria, compartida por todo el proceso. El
+    archivo se revisa (stat) a lo más cada ADMINS_CHECK_SECONDS y se
+    vuelve a leer solo si cambió"""
+    
+    def __init__(self, admins_file, check_seconds):
+        self.admins_file = admins_file
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.emails = ()
+        self.mtime = None
+        self.checked_at = None
+    
+    def get(self):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.check_seconds:
+            with self.lock:
+                # Otro hilo pudo revisarlo mientras esperábamos
+                if self.checked_at is None or now - self.checked_at >= self.check_seconds:
+                    try:
+                        mtime = os.stat(self.admins_file).st_mtime_ns
+                    except FileNotFoundError:
+                        mtime = None
+                    if self.checked_at is None or mtime != self.mtime:
+                        self.emails = tuple(read_admin_emails())
+                        self.mtime = mtime
+                    self.checked_at = now
+        return self.emails
+
+admin_list = AdminList(ADMINS_FILE, ADMINS_CHECK_SECONDS)
+
+def get_admin_emails():
+    """Lista de emails de administradores, desde la caché"""
+    return list(admin_list.get())
+
+def is_admin(email):
+    """Verifica si un email tiene permisos de administrador"""
+    return bool(email) and email.strip().lower() in admin_list.get()
+
+class AuthCache:
+    """Caché de keys ya validadas: key_hash -> (email, rol), cada una
+    vale AUTH_CACHE_TTL segundos"""
+    
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+    
+    def get(self, key_hash):
+        entry = self.entries.get(key_hash)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+    
+    def put(self, key_hash, email, role):
+        with self.lock:
+            # Al llenarse se descartan las más viejas
+            if len(self.entries) >= self.max_entries:
+                oldest = sorted(self.entries, key=lambda k: self.entries[k][0])[:self.max_entries // 4]
+                for k in oldest:
+                    del self.entries[k]
+            self.entries[key_hash] = (time.monotonic(), (email, role))
+    
+    def invalidate(self, key_hash):
+        with self.lock:
+            self.entries.pop(key_hash, None)
+
 #########################################################################
 ######################### API Keys ######################################
 #########################################################################
@@ -42,37 +119,129 @@ def get_admin_emails():
 class APIKeyManager:
     def __init__(self, keys_file):
         self.keys_file = keys_file
-        self.admin_emails = get_admin_emails()
+        # Decisiones recientes de autenticación
+        self.auth_cache = AuthCache(AUTH_CACHE_TTL)
+        # Las keys viven en memoria, el archivo se lee solo si cambió
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.keys_mtime = None
+        self.checked_at = None
+        # Últimos usos pendientes de escribir: key_hash -> fecha
+        self.pending_last_used = {}
+        self.flusher = None
         self.load_keys()
+        # Lo pendiente se escribe al terminar el proceso
+        atexit.register(self.flush)
+    
+    @contextmanager
+    def file_lock(self):
+        """Bloqueo entre procesos (workers) para modificar el archivo de keys"""
+        with open(self.keys_file + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def read_keys(self):
+        """Lee las API keys del archivo, regresa (keys, mtime). Solo un
+        archivo que no existe da keys vacías, cualquier otro error se
+        lanza para no perder las keys que ya hay"""
+        try:
+            mtime = os.stat(self.keys_file).st_mtime_ns
+            with open(self.keys_file, 'r') as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            return {}, None
+        keys = json.loads(content) if content else {}
+        if not isinstance(keys, dict):
+            raise ValueError("API keys file is not a JSON object")
+        return keys, mtime
     
     def load_keys(self):
-        """Carga las API keys desde el archivo"""
+        """Carga las API keys desde el archivo, si falla se quedan las de memoria"""
         try:
-            if os.path.exists(self.keys_file):
-                with open(self.keys_file, 'r') as f:
-                    content = f.read().strip()
-                    if content:
-                        self.keys = json.loads(content)
-                    else:
-                        self.keys = {}
-            else:
-                self.keys = {}
-        except json.JSONDecodeError as e:
-            print(f"Error: Invalid JSON in API keys file: {e}")
-            self.keys = {}
+            keys, mtime = self.read_keys()
         except Exception as e:
             print(f"Error loading API keys: {e}")
-            self.keys = {}
+            return
+        with self.lock:
+            self.keys = keys
+            self.keys_mtime = mtime
+    
+    def reload_if_changed(self):
+        """Recarga las keys si otro proceso modificó el archivo"""
+        try:
+            mtime = os.stat(self.keys_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.keys_mtime:
+            self.load_keys()
+    
+    def check_keys_file(self):
+        """Recarga las keys si el archivo cambió (ej. una key revocada en
+        otro worker), se revisa a lo más cada API_KEYS_CHECK_SECONDS"""
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= API_KEYS_CHECK_SECONDS:
+            self.checked_at = now
+            self.reload_if_changed()
     
     def save_keys(self):
-        """Guarda las API keys en el archivo"""
+        """Guarda las API keys en el archivo, de forma atómica"""
         try:
-            with open(self.keys_file, 'w') as f:
+            tmp_file = f"{self.keys_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
                 json.dump(self.keys, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            # Nadie lee un archivo a medio escribir
+            os.replace(tmp_file, self.keys_file)
+            self.keys_mtime = os.stat(self.keys_file).st_mtime_ns
         except Exception as e:
             print(f"Error saving API keys: {e}")
             raise Exception(f"Failed to save API keys: {e}")
     
+    def update_keys(self, change):
+        """Aplica un cambio sobre las keys más recientes del archivo y las
+        guarda, si el archivo no se puede leer no se escribe nada"""
+        with self.file_lock():
+            keys, mtime = self.read_keys()
+            with self.lock:
+                self.keys, self.keys_mtime = keys, mtime
+                result = change(self.keys)
+                # Los usos pendientes también se escriben
+                self.merge_pending()
+                self.save_keys()
+        return result
+    
+    def merge_pending(self):
+        """Pasa los últimos usos pendientes a las keys (con self.lock tomado)"""
+        for key_hash, last_used in self.pending_last_used.items():
+            if key_hash in self.keys and (self.keys[key_hash].get('last_used') or '') < last_used:
+                self.keys[key_hash]['last_used'] = last_used
+        self.pending_last_used = {}
+    
+    def flush(self):
+        """Escribe los últimos usos pendientes, o recarga si el archivo cambió"""
+        try:
+            if self.pending_last_used:
+                self.update_keys(lambda keys: None)
+            else:
+                self.reload_if_changed()
+        except Exception as e:
+            print(f"Error flushing API keys: {e}")
+    
+    def start_flusher(self):
+        """Hilo que escribe los últimos usos cada API_KEYS_FLUSH_SECONDS"""
+        def run():
+            while True:
+                time.sleep(API_KEYS_FLUSH_SECONDS)
+                self.flush()
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=run, name="apikeys-flush", daemon=True)
+                self.flusher.start()
+    
     def generate_api_key(self, email):
         """Genera una nueva API key para un email"""
         if not email or not email.strip():
@@ -90,45 +259,68 @@ class APIKeyManager:
         # Hash de la clave para almacenamiento seguro
         key_hash = hashlib.sha256(raw_key.encode()).hexdigest()
         
-        # Verificar si ya existe una key activa para este email
-        for key_data in self.keys.values():
-            if key_data.get('email') == email and key_data.get('active', False):
-                raise ValueError(f"Active API key already exists for email: {email}")
-        
-        # Guardar el hash y la información del usuario
-        self.keys[key_hash] = {
-            'email': email,
-            'created_at': datetime.now().isoformat(),
-            'active': True,
-            'last_used': None
-        }
+        def add_key(keys):
+            # Verificar si ya existe una key activa para este email
+            for key_data in keys.values():
+                if key_data.get('email') == email and key_data.get('active', False):
+                    raise ValueError(f"Active API key already exists for email: {email}")
+            
+            # Guardar el hash y la información del usuario
+            keys[key_hash] = {
+                'email': email,
+                'created_at': datetime.now().isoformat(),
+                'active': True,
+                'last_used': None
+            }
         
-        self.save_keys()
+        self.update_keys(add_key)
         return raw_key
     
-    def validate_api_key(self, api_key):
-        """Valida una API key y retorna el email del usuario"""
+    def authenticate(self, api_key):
+        """Valida una API key y retorna (email, rol), rol es 'admin' o 'user'"""
         if not api_key or not api_key.strip():
             return None
         
         try:
             key_hash = hashlib.sha256(api_key.strip().encode()).hexdigest()
             
-            if key_hash in self.keys and self.keys[key_hash].get('active', False):
-                # Actualizar último uso
-                self.keys[key_hash]['last_used'] = datetime.now().isoformat()
-                try:
-                    self.save_keys()
-                except:
-                    pass  # No fallar la validación si no se puede guardar el último uso
+            auth = self.auth_cache.get(key_hash)
+            if auth is None:
+                # Una key desconocida pudo ser creada por otro worker
+                if key_hash not in self.keys:
+                    self.reload_if_changed()
+                else:
+                    self.check_keys_file()
                 
-                return self.keys[key_hash]['email']
+                keys = self.keys
+                key_data = keys.get(key_hash)
+                if not key_data or not key_data.get('active', False):
+                    return None
+                
+                email = key_data['email']
+                auth = (email, 'admin' if is_admin(email) else 'user')
+                with self.lock:
+                    # Si las keys cambiaron mientras tanto (ej. se revocó)
+                    # no se guarda una decisión vieja
+                    if self.keys is keys:
+                        self.auth_cache.put(key_hash, *auth)
             
-            return None
+            # El último uso se guarda en memoria y se escribe después
+            with self.lock:
+                self.pending_last_used[key_hash] = datetime.now().isoformat()
+            if self.flusher is None:
+                self.start_flusher()
+            
+            return auth
         except Exception as e:
             print(f"Error validating API key: {e}")
             return None
     
+    def validate_api_key(self, api_key):
+        """Valida una API key y retorna el email del usuario"""
+        auth = self.authenticate(api_key)
+        return auth[0] if auth else None
+    
     def revoke_api_key(self, api_key):
         """Revoca una API key"""
         if not api_key:
@@ -136,21 +328,28 @@ class APIKeyManager:
         
         try:
             key_hash = hashlib.sha256(api_key.encode()).hexdigest()
-            if key_hash in self.keys:
-                self.keys[key_hash]['active'] = False
-                self.keys[key_hash]['revoked_at'] = datetime.now().isoformat()
-                self.save_keys()
+            
+            def revoke(keys):
+                if key_hash not in keys:
+                    return False
+                keys[key_hash]['active'] = False
+                keys[key_hash]['revoked_at'] = datetime.now().isoformat()
                 return True
-            return False
+            
+            revoked = self.update_keys(revoke)
+            # Después de guardar, así nadie la vuelve a meter en la caché
+            self.auth_cache.invalidate(key_hash)
+            return revoked
         except Exception as e:
             print(f"Error revoking API key: {e}")
             return False
     
     def list_api_keys(self, admin_email):
         """Lista todas las API keys (solo para admins)"""
-        if admin_email not in self.admin_emails:
+        if not is_admin(admin_email):
             raise PermissionError("Admin privileges required")
         
+        self.reload_if_changed()
         keys_info = []
         for key_hash, key_data in self.keys.items():
             keys_info.append({
@@ -170,25 +369,22 @@ api_key_manager = APIKeyManager(API_KEYS_FILE)
 ######################### Logs ##########################################
 #########################################################################
 
-def log_operation(email, operation, input_data, output_data):
-    """Registra una operación en el log"""
-    try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # Sanitizar datos para evitar inyección de comandos
-        email_clean = email.replace('"', '\\"').replace('\n', ' ').replace('\r', ' ')
-        operation_clean = operation.replace('"', '\\"').replace('\n', ' ').replace('\r', ' ')
-        input_clean = str(input_data).replace('"', '\\"').replace('\n', ' ').replace('\r', ' ')
-        output_clean = str(output_data).replace('"', '\\"').replace('\n', ' ').replace('\r', ' ')
-        
-        log_entry = f'"{email_clean}" | "{operation_clean}" | "{input_clean}" > "{output_clean}" ? "{timestamp}"\n'
-        
-        # Escribir directamente al archivo en lugar de usar os.system
-        with open(API_LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
-            
-    except Exception as e:
-        print(f"Error logging operation: {e}")
+def log_operation(email, operation, input_data, output_data, count_tokens=None, **fields):
+    """Registra una operación en el log (JSON lines) sin bloquear la
+    request, fields son datos extra como los tiempos: embed_ms,
+    query_ms, llm_ms... count_tokens son textos {campo: texto} cuyos
+    tokens cuenta el hilo del log, ej. {'prompt_tokens': prompt}"""
+    record = {
+        'timestamp': datetime.now().isoformat(),
+        'email': email,
+        'operation': operation,
+        'input': input_data,
+        'output': output_data,
+        **fields
+    }
+    if count_tokens:
+        record['count_tokens'] = count_tokens
+    log_writer.write(record)
 
 #########################################################################
 ######################### Utils for API #################################
@@ -208,15 +404,15 @@ def require_api_key(f):
             }), 401
         
         # Validar API key
-        email = api_key_manager.validate_api_key(api_key)
-        if not email:
+        auth = api_key_manager.authenticate(api_key)
+        if not auth:
             return jsonify({
                 'error': 'Invalid authentication',
                 'details': 'Invalid or expired API key'
             }), 401
         
-        # Agregar el email al contexto de la request
-        request.user_email = email
+        # Agregar el email y el rol al contexto de la request
+        request.user_email, request.user_role = auth
         return f(*args, **kwargs)
     
     return decorated_function
@@ -232,11 +428,8 @@ def require_admin(f):
                 'details': 'Must be authenticated to access admin endpoints'
             }), 401
         
-        # Recargar emails de admin por si han cambiado
-        admin_emails = get_admin_emails()
-        
-        # Verificar permisos de admin
-        if request.user_email not in admin_emails:
+        # Verificar permisos de admin, el rol viene de require_api_key
+        if getattr(request, 'user_role', None) != 'admin':
             return jsonify({
                 'error': 'Insufficient privileges',
                 'details': 'Administrator privileges required for this operation'
@@ -245,8 +438,3 @@ def require_admin(f):
         return f(*args, **kwargs)
     
     return decorated_function
-
-def is_admin(email):
-    """Verifica si un email tiene permisos de administrador"""
-    admin_emails = get_admin_emails()
-    return email in admin_emails
\ No newline at end of file
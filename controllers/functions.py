@@ -1,6 +1,12 @@
 import os
-from flask import jsonify
+import json
+import time
+from flask import jsonify, Response, stream_with_context
 from .auth import api_key_manager, log_operation, is_admin
+from modules.db import get_sdb
+from modules.llm import chat, chat_stream
+from modules.prompt import create_prompt
+from modules.extras import elapsed_ms
 
 #########################################################################
 ######################### Validation ####################################
@@ -16,52 +22,220 @@ def validate_required_fields(data, required_fields):
     if missing_fields:
         raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
 
+def validate_collection_name(collection):
+    """Valida el nombre de una colección, solo letras, números, guiones y
+    guiones bajos (también evita rutas fuera de COLLECTIONS_PATH)"""
+    if not collection.replace('_', '').replace('-', '').isalnum():
+        raise ValueError("Collection name can only contain letters, numbers, hyphens and underscores")
+
+def validate_chat_filters(data):
+    """Valida los filtros opcionales del chat y los convierte para SDB.query"""
+    filters = {}
+    
+    source = data.get('source')
+    if source is not None:
+        if isinstance(source, str):
+            source = [source]
+        if not isinstance(source, list) or not all(isinstance(s, str) and s.strip() for s in source):
+            raise ValueError("source must be a file name or a list of file names")
+        filters['source'] = [s.strip() for s in source]
+    
+    pages = data.get('pages')
+    if pages is not None:
+        if isinstance(pages, int) and not isinstance(pages, bool):
+            pages = [pages, pages]
+        if not isinstance(pages, list) or len(pages) != 2 or not all(isinstance(p, int) and not isinstance(p, bool) for p in pages):
+            raise ValueError("pages must be a page number or a [first, last] range")
+        filters['pages'] = (min(pages), max(pages))
+    
+    ntitle = data.get('ntitle')
+    if ntitle is not None:
+        if isinstance(ntitle, int) and not isinstance(ntitle, bool):
+            ntitle = [ntitle]
+        if not isinstance(ntitle, list) or not all(isinstance(n, int) and not isinstance(n, bool) for n in ntitle):
+            raise ValueError("ntitle must be a heading level or a list of them")
+        filters['ntitle'] = ntitle
+    
+    links = data.get('links')
+    if links is not None:
+        if not isinstance(links, bool):
+            raise ValueError("links must be true or false")
+        filters['links'] = links
+    
+    return filters
+
 #########################################################################
 ######################### Chat ##########################################
 #########################################################################
 
+def parse_chat_request(data):
+    """Valida una petición de chat, regresa (collection, prompt, only_embeddings, filters)"""
+    # Validar campos requeridos
+    validate_required_fields(data, ['collection', 'prompt'])
+    
+    collection = data.get('collection').strip()
+    prompt = data.get('prompt').strip()
+    only_embeddings = data.get('onlyembeddings', False)
+    # Filtros opcionales: source, pages, ntitle, links
+    filters = validate_chat_filters(data)
+    
+    # Validaciones adicionales
+    validate_collection_name(collection)
+    
+    if len(prompt) < 3:
+        raise ValueError("Prompt must be at least 3 characters long")
+    
+    if len(prompt) > 10000:
+        raise ValueError("Prompt is too long (maximum 10000 characters)")
+    
+    return collection, prompt, only_embeddings, filters
+
+def sse_event(data, event=None):
+    """Formatea un evento de Server-Sent Events con datos en JSON"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def chat_log_input(collection, prompt, only_embeddings, filters):
+    """Datos de una petición de chat para el log"""
+    return {
+        'collection': collection,
+        'prompt_length': len(prompt),
+        'only_embeddings': only_embeddings,
+        'filters': filters
+    }
+
+def chat_log_tokens(full_prompt, answer):
+    """Textos del chat cuyos tokens se cuentan en el hilo del log"""
+    return {'prompt_tokens': full_prompt, 'answer_tokens': answer}
+
+def get_coincidences(data):
+    """Número de chunks a buscar, por defecto DEFAULT_COINCIDENCES"""
+    try:
+        coincidences = int(data.get('coincidences', os.environ.get("DEFAULT_COINCIDENCES", 3)))
+    except (TypeError, ValueError):
+        raise ValueError("coincidences must be a number")
+    if coincidences < 1 or coincidences > 100:
+        raise ValueError("coincidences must be between 1 and 100")
+    return coincidences
+
 def chat_handler(data, user_email):
     """Handler para el endpoint de chat"""
     try:
-        # Validar campos requeridos
-        validate_required_fields(data, ['collection', 'prompt'])
-        
-        collection = data.get('collection').strip()
-        prompt = data.get('prompt').strip()
-        only_embeddings = data.get('onlyembeddings', False)
-        
-        # Validaciones adicionales
-        if len(prompt) < 3:
-            raise ValueError("Prompt must be at least 3 characters long")
-        
-        if len(prompt) > 10000:
-            raise ValueError("Prompt is too long (maximum 10000 characters)")
+        started = time.perf_counter()
+        collection, prompt, only_embeddings, filters = parse_chat_request(data)
+        coincidences = get_coincidences(data)
         
         # Log de la operación
-        input_data = f"collection: {collection}, prompt_length: {len(prompt)}, only_embeddings: {only_embeddings}"
+        input_data = chat_log_input(collection, prompt, only_embeddings, filters)
         
-        # TODO: Aquí va la lógica del chat con la colección
-        # Integrar el código necesario para procesar el chat
+        # La SDB abierta del proceso, o se abre la primera vez
+        sdb = get_sdb(collection)
+        # Tiempos de la request para el log
+        timings = {}
+        context = sdb.query(prompt, coincidences, timings=timings, **filters)
         
-        # Por ahora retornamos una respuesta de ejemplo
-        answer = f"Chat response for collection '{collection}' with prompt of {len(prompt)} characters"
+        # Solo los chunks encontrados, sin LLM
         if only_embeddings:
-            answer += " (embeddings only)"
-        
-        log_operation(user_email, "CHAT", input_data, answer[:100])
+            answer = None
+            timings['total_ms'] = elapsed_ms(started)
+            log_operation(user_email, "CHAT", input_data, f"{len(context)} chunks", **timings)
+        else:
+            full_prompt = create_prompt(context, prompt, sdb.config)
+            llm_started = time.perf_counter()
+            answer = chat(
+                sdb.config["llm_provider"],
+                sdb.config["llm"],
+                full_prompt,
+                sdb.response_cache_version(),
+                timings
+            )
+            timings['llm_ms'] = elapsed_ms(llm_started)
+            timings['total_ms'] = elapsed_ms(started)
+            log_operation(user_email, "CHAT", input_data, answer[:100], count_tokens=chat_log_tokens(full_prompt, answer), **timings)
         
         return jsonify({
             'success': True,
             'answer': answer,
+            'context': context,
             'collection': collection,
-            'only_embeddings': only_embeddings
+            'only_embeddings': only_embeddings,
+            'filters': filters
         })
         
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         return jsonify({'error': f'Chat processing failed: {str(e)}'}), 500
 
+def chat_stream_handler(data, user_email):
+    """Handler para el endpoint de chat en streaming (Server-Sent Events)"""
+    try:
+        started = time.perf_counter()
+        collection, prompt, only_embeddings, filters = parse_chat_request(data)
+        coincidences = get_coincidences(data)
+        
+        # La búsqueda se hace antes de abrir el stream, así los errores
+        # regresan con su código de estado
+        sdb = get_sdb(collection)
+        timings = {}
+        context = sdb.query(prompt, coincidences, timings=timings, **filters)
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': f'Chat processing failed: {str(e)}'}), 500
+    
+    input_data = chat_log_input(collection, prompt, only_embeddings, filters)
+    
+    def events():
+        # Primero el contexto encontrado
+        yield sse_event({'context': context}, 'context')
+        if only_embeddings:
+            timings['total_ms'] = elapsed_ms(started)
+            log_operation(user_email, "CHAT_STREAM", input_data, f"{len(context)} chunks", **timings)
+            yield sse_event({'success': True}, 'done')
+            return
+        
+        # Después la respuesta, pieza por pieza
+        full_prompt = create_prompt(context, prompt, sdb.config)
+        llm_started = time.perf_counter()
+        answer = []
+        try:
+            for piece in chat_stream(
+                sdb.config["llm_provider"],
+                sdb.config["llm"],
+                full_prompt,
+                sdb.response_cache_version(),
+                timings
+            ):
+                # Tiempo hasta la primera pieza
+                if not answer:
+                    timings['first_token_ms'] = elapsed_ms(llm_started)
+                answer.append(piece)
+                yield sse_event({'token': piece})
+        except Exception as e:
+            timings['llm_ms'] = elapsed_ms(llm_started)
+            log_operation(user_email, "CHAT_STREAM", input_data, f"error: {e}", **timings)
+            yield sse_event({'error': f'Chat processing failed: {str(e)}'}, 'error')
+            return
+        
+        answer = "".join(answer)
+        timings['llm_ms'] = elapsed_ms(llm_started)
+        timings['total_ms'] = elapsed_ms(started)
+        log_operation(user_email, "CHAT_STREAM", input_data, answer[:100], count_tokens=chat_log_tokens(full_prompt, answer), **timings)
+        yield sse_event({'success': True}, 'done')
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        # Sin buffers intermedios, cada evento sale en cuanto se genera
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 def manage_collection_handler(data, user_email):
     """Handler para crear y agregar elementos a una colección"""
     try:
@@ -314,9 +488,73 @@ def get_embeddings_handler():
                 'status': 'available'
             },
             {
-                'name': 'HuggingFace',
-                'models': ['sentence-transformers/all-MiniLM-L6-v2', 'sentence-transformers/all-mpnet-base-v2'],
+                'name': 'Local',
+                'models': ['all-MiniLM-L6-v2', 'all-mpnet-base-v2'],
                 'status': 'available'
             },
             {
-                'name': '
\ No newline at end of file
+                'name': 'Ollama',
+                'models': ['nomic-embed-text', 'mxbai-embed-large', 'all-minilm'],
+                'status': 'available'
+            }
+        ]
+        
+        return jsonify({
+            'success': True,
+            'providers': providers
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Failed to retrieve embedding providers: {str(e)}'}), 500
+
+def get_settings_handler(collection):
+    """Handler para obtener la configuración de una colección"""
+    try:
+        collection = collection.strip()
+        validate_collection_name(collection)
+        config_path = os.path.join(os.environ["COLLECTIONS_PATH"], collection, "config.json")
+        
+        if not os.path.exists(config_path):
+            raise FileNotFoundError(f"Collection '{collection}' not found")
+        
+        with open(config_path, 'r') as f:
+            settings = json.load(f)
+        
+        return jsonify({
+            'success': True,
+            'collection': collection,
+            'settings': settings
+        })
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': f'Failed to retrieve settings: {str(e)}'}), 500
+
+#########################################################################
+######################### API Keys ######################################
+#########################################################################
+
+def generate_api_key_handler(data, user_email):
+    """Handler para generar nuevas API keys (solo admins)"""
+    try:
+        # Validar campos requeridos
+        validate_required_fields(data, ['email'])
+        
+        email = data.get('email').strip()
+        api_key = api_key_manager.generate_api_key(email)
+        
+        log_operation(user_email, "APIKEY_CREATE", f"email: {email}", "API key generated")
+        
+        return jsonify({
+            'success': True,
+            'api_key': api_key,
+            'email': email.lower()
+        })
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'API key generation failed: {str(e)}'}), 500
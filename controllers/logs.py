@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import glob
+import fcntl
+import queue
+import atexit
+import threading
+from datetime import datetime
+from modules.chunking import count_tokens
+
+#########################################################################
+######################### Globals #######################################
+#########################################################################
+
+API_LOG_FILE = os.getenv('API_LOG_FILE', 'log.txt')
+# Registros en espera, si se llena se descartan en vez de frenar la request
+API_LOG_QUEUE_SIZE = int(os.getenv('API_LOG_QUEUE_SIZE', 10000))
+# Rotación por tamaño y por tiempo, y cuántos archivos viejos se guardan
+API_LOG_MAX_MB = float(os.getenv('API_LOG_MAX_MB', 50))
+API_LOG_ROTATE_HOURS = float(os.getenv('API_LOG_ROTATE_HOURS', 24))
+API_LOG_BACKUPS = int(os.getenv('API_LOG_BACKUPS', 10))
+
+#########################################################################
+######################### Writer ########################################
+#########################################################################
+
+class LogWriter:
+    """Escribe el log en JSON lines desde un hilo en segundo plano, las
+    requests solo dejan el registro en una cola"""
+
+    def __init__(self, path, queue_size, max_bytes, rotate_seconds, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+        self.file = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        """Encola un registro, nunca bloquea"""
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="api-log", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def close(self):
+        """Escribe lo pendiente y termina el hilo"""
+        if self.thread is not None and self.thread.is_alive():
+            try:
+                # Con la cola llena no se espera para siempre al salir
+                self.queue.put(None, timeout=5)
+            except queue.Full:
+                return
+            self.thread.join(timeout=5)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            # Todo lo que ya está en la cola se escribe de una vez
+            batch = [record]
+            while record is not None and len(batch) < 1000:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(record)
+            records = [r for r in batch if r is not None]
+            if records:
+                try:
+                    self.write_lines(records)
+                except Exception as e:
+                    print(f"Error logging operation: {e}")
+            if batch[-1] is None:
+                if self.file:
+                    self.file.close()
+                return
+
+    def write_lines(self, records):
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            records.append({'timestamp': datetime.now().isoformat(), 'operation': 'LOG_DROPPED', 'count': dropped})
+        for record in records:
+            # Los tokens se cuentan aquí, fuera de la request
+            for field, text in record.pop('count_tokens', {}).items():
+                record[field] = count_tokens(text or "")
+        self.open_current()
+        self.maybe_rotate()
+        lines = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records)
+        # Un solo write en modo append, las líneas de varios workers no se mezclan
+        self.file.write(lines)
+        self.file.flush()
+
+    def open_current(self):
+        """Abre el log, o lo vuelve a abrir si otro worker lo rotó"""
+        if self.file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.file.close()
+        self.open_file()
+
+    def open_file(self):
+        self.file = open(self.path, 'a', encoding='utf-8')
+        # Periodo de rotación al que pertenece lo ya escrito
+        self.period = self.period_of(os.fstat(self.file.fileno()).st_mtime)
+
+    def period_of(self, timestamp):
+        return int(timestamp // self.rotate_seconds)
+
+    def maybe_rotate(self):
+        stat = os.fstat(self.file.fileno())
+        too_big = stat.st_size >= self.max_bytes
+        # Se rota al empezar un nuevo periodo (cada API_LOG_ROTATE_HOURS)
+        too_old = stat.st_size > 0 and self.period_of(time.time()) != self.period
+        if not too_big and not too_old:
+            return
+        # Solo un worker rota, los demás vuelven a abrir el archivo nuevo
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path) and os.stat(self.path).st_ino == stat.st_ino:
+                    os.replace(self.path, f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+                    # Solo se guardan los más recientes
+                    old_logs = sorted(glob.glob(glob.escape(self.path) + ".2*"))
+                    for old in old_logs[:-self.backups] if self.backups > 0 else old_logs:
+                        os.remove(old)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.file.close()
+        self.open_file()
+
+log_writer = LogWriter(
+    API_LOG_FILE,
+    API_LOG_QUEUE_SIZE,
+    API_LOG_MAX_MB * 1024 * 1024,
+    API_LOG_ROTATE_HOURS * 3600,
+    API_LOG_BACKUPS
+)
@@ -1,16 +1,30 @@
 import os
 import sys
 import json
+import time
 import shutil
+import fcntl
+import signal
+import socket
+import subprocess
 import pyperclip
 from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
 # import modules
-from modules.llm import chat # used to call an LLM
+from modules.llm import chat_stream # used to call an LLM
 from modules.db import new_sdb, SDB # create and instance an SDB
-from modules.scrapper import get_content # get content from files
+from modules.scrapper import get_content, stream_content # get content from files
+from modules.scrapper import get_registry # scrappers available
+from modules.scrapper import init_ingest_worker # settings of the parse processes
 from modules.extras import move_to_sdb, which_sdb # manage the current_sdb file
+from modules.extras import InlineExecutor # run pool tasks on the same process
+from modules.extras import api_pid, api_pid_file # the api server process
+from modules.extras import walk_files, parse_flags, parse_size # find files in folders
+from modules.extras import parse_filters # filters for the chats
 from modules.prompt import create_prompt # function to create the prompt
+from modules.manifest import Manifest # files added to an sdb
+from modules.cache import cache_path, get_response_cache # llm answers cache stats
 
 
 # the main path of the project
@@ -19,6 +33,45 @@ main_path = os.environ["COLLECTIONS_PATH"]
 current_dir = os.environ["CURRENT_PATH"] + "/"
 
 
+# check if something takes connections on the host and port
+def port_open (host: str, port: int) -> bool:
+    # the api listens on every interface, it's checked on localhost
+    if host in ("0.0.0.0", ""):
+        host = "127.0.0.1"
+    try:
+        with socket.create_connection((host, port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+# send a signal to the api and its uvicorn workers, ker run starts it
+# as the leader of its own process group
+def signal_api (pid: int, sig: int):
+    try:
+        if os.getpgid(pid) == pid:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+# check if a process of the api group is still alive
+def api_group_running (pid: int) -> bool:
+    try:
+        os.killpg(pid, 0)
+        return True
+    except (ProcessLookupError, PermissionError):
+        return False
+
+
+# sdbs embedded with the old ollama endpoint still work, but with
+# vectors that aren't normalized, ker migrate embeds them again
+def warn_legacy_embeddings (sdb: SDB):
+    if sdb.legacy_embeddings():
+        print('\033[93m' + "This SDB uses the old Ollama embeddings, to embed it again run: " + '\033[0m' + f"ker migrate {sdb.name}\n")
+
+
 # main command handler
 class Brain:
 
@@ -34,8 +87,10 @@ class Brain:
             'add': self.handle_add,
             'adds': self.handle_add,
             'set': self.handle_set,
+            'migrate': self.handle_migrate,
             'chat': self.handle_use,
             'chate': self.handle_usem,
+            'run': self.handle_start,
             'start': self.handle_start,
             'stop': self.handle_stop
             # help command is considered on bin/ker
@@ -130,10 +185,10 @@ class Brain:
             # check if the name is in collections
             if name in os.listdir(main_path):
                 print('\033[92m' + "Files included in \033[0m" + name + ":")
-                # then check the included file
-                with open(main_path + name + "/included.txt", 'r') as f:
-                    for line in f:
-                        print('\t'+line, end='')
+                # then check the manifest
+                manifest = Manifest(main_path + name)
+                for entry in manifest.files.values():
+                    print(f"\t{entry['source']} ({len(entry['chunks'])} items)")
             # if collection not found
             else:
                 print('\033[91m' + "Not found collection: "+ '\033[0m' + name)
@@ -143,6 +198,10 @@ class Brain:
             for db in os.listdir(main_path):
                 if not db.startswith("."):
                     print(f"\t- {db}")
+            # answers reused by the sdbs with "response_cache": true
+            if os.path.exists(cache_path("responses.sqlite3")):
+                stats = get_response_cache().stats()
+                print('\n\033[92m' + "LLM answers cache: " + '\033[0m' + f"{stats['hits']} hits, {stats['misses']} misses")
 
 ################################################################################
 
@@ -154,21 +213,52 @@ class Brain:
             # no database selected
             print('\033[91m' + "SDB not selected, use: " + f'\033[0mker mv [SDB name]')
             return
+        # get the options for folders
+        args, flags = parse_flags(args, ["--include", "--exclude", "--max-size"])
+        include = flags["--include"]
+        exclude = flags["--exclude"]
+        try:
+            max_size = parse_size(flags["--max-size"][-1]) if flags["--max-size"] else None
+        except ValueError:
+            print('\033[91m' + "Invalid --max-size, use bytes or 500K, 20M, 1G" + '\033[0m')
+            return
         # print adding message
         print('\033[92m' + "Adding memories to " + '\033[0m' + name + '\033[92m' + "..." + '\033[0m\n')
         # instance the db
         sdb = SDB(name)
+        warn_legacy_embeddings(sdb)
+        # and the record of files already added
+        manifest = Manifest(sdb.dir)
         # counter of items
         added_count = 0
+        removed_count = 0
+        skipped_count = 0
 
-        # helper to process a single file
-        def process_file(file_path):
-            nonlocal added_count
+        # files that are being parsed: future -> (file_path, full_file_path, stat, hash)
+        pending = {}
+
+        # helper to store the content of a parsed file
+        def store_content(file_path, full_file_path, stat, hash, future):
+            nonlocal added_count, removed_count
             try:
-                # get the file content
-                content, new_path = get_content(file_path, current_dir, name)
+                # get the file content parsed by the worker, or a
+                # generator of it when files are parsed here
+                content, new_path = future.result()
+                # keep the ids of the chunks as they pass to the db
+                chunks = []
+                def track(content):
+                    for c in content:
+                        chunks.append(c['id'])
+                        yield c
                 # and let the db add the content
-                added = sdb.add_documents(content)
+                added = sdb.add_documents(track(content))
+                print(f"\n\033[92mfound {len(chunks)} items in \033[0m{file_path}")
+                # if the file was modified, remove the chunks that are gone
+                entry = manifest.get(full_file_path)
+                if entry:
+                    removed_count += sdb.delete_documents(set(entry["chunks"]) - set(chunks))
+                # record the file on the manifest, each chunk once
+                manifest.update(full_file_path, file_path, stat, list(dict.fromkeys(chunks)), hash)
                 # if it's correct, then save the file in assets
                 if added > 0:
                     # copy the file to assets
@@ -179,25 +269,105 @@ class Brain:
                 # print error message
                 print('\n\033[91m' + "Error processing file " + f'\033[0m {file_path}:', e)
 
-        # iterate over each path in args
-        for path in args:
-            # get full path
-            full_path = os.path.join(current_dir, path)
-            # if it's a folder
-            if os.path.isdir(full_path):
-                # iterate each file in the folder
-                for filename in os.listdir(full_path):
-                    file_path = os.path.join(path, filename)
-                    # only process if it's a file
-                    if os.path.isfile(os.path.join(current_dir, file_path)):
+        # helper to store the files that already finished parsing,
+        # wait_all blocks until every pending file is stored
+        def drain(wait_all=False):
+            while pending:
+                done, _ = wait(pending, return_when=ALL_COMPLETED if wait_all else FIRST_COMPLETED)
+                for future in done:
+                    store_content(*pending.pop(future), future)
+                # leave the rest parsing while new files are sent
+                if not wait_all:
+                    return
+
+        # helper to process a single file
+        def process_file(file_path):
+            nonlocal skipped_count
+            try:
+                full_file_path = os.path.abspath(os.path.join(current_dir, file_path))
+                # the stat and hash of the file as it is before parsing
+                stat = os.stat(full_file_path)
+                unchanged, hash = manifest.check(full_file_path, stat)
+                # if the file did not change since it was added, skip it
+                if unchanged:
+                    skipped_count += 1
+                    return
+                # find the scrapper that can read the file
+                scrapper = registry.for_path(full_file_path)
+                if scrapper is None:
+                    raise ValueError(f"Only accepted {', '.join(registry.extensions())} files")
+                # keep a bounded number of files in the pools, so the
+                # embeddings start while the rest are being parsed
+                if len(pending) >= 2 * workers:
+                    drain()
+                # send it to be parsed on the pool for its cost
+                future = pools[scrapper.cost].submit(parse, file_path, current_dir, name)
+                pending[future] = (file_path, full_file_path, stat, hash)
+            except Exception as e:
+                # print error message
+                print('\n\033[91m' + "Error processing file " + f'\033[0m {file_path}:', e)
+
+        # helper to remove files that were deleted from a folder
+        def remove_missing(folder_path):
+            nonlocal removed_count
+            for full_file_path in manifest.files_under(os.path.abspath(folder_path)):
+                if not os.path.exists(full_file_path):
+                    entry = manifest.remove(full_file_path)
+                    removed_count += sdb.delete_documents(entry["chunks"])
+                    print('\033[93m' + "Removed deleted file " + f'\033[0m{entry["source"]}')
+
+        # number of workers that parse files in parallel
+        workers = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 1))
+        # cpu bound scrappers run on processes and io bound ones on threads
+        registry = get_registry()
+        if workers > 1:
+            # the processes reading the pages of big pdfs are split
+            # between the files parsed at the same time
+            page_workers = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+            cpu_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_ingest_worker,
+                initargs=(max(1, page_workers // workers),)
+            )
+            pools = {"cpu": cpu_pool, "io": ThreadPoolExecutor(max_workers=workers)}
+            parse = get_content
+        # with one worker files are parsed in this same process, streaming
+        # the chunks to the db while the file is parsed
+        else:
+            inline = InlineExecutor()
+            pools = {"cpu": inline, "io": inline}
+            parse = stream_content
+
+        try:
+            # iterate over each path in args
+            for path in args:
+                # get full path
+                full_path = os.path.join(current_dir, path)
+                # if it's a folder
+                if os.path.isdir(full_path):
+                    # walk the folder tree, each file is sent to parse as it's found
+                    for file_path in walk_files(path, current_dir, include, exclude, max_size):
                         process_file(file_path)
-            # if it's a file
-            elif os.path.isfile(full_path):
-                process_file(path)
-            # if it's not found
-            else:
-                print('\033[91m' + f"Path not found: {path}" + '\033[0m')
+                    # and forget the files that are not there anymore
+                    remove_missing(full_path)
+                # if it's a file
+                elif os.path.isfile(full_path):
+                    process_file(path)
+                # if it's not found
+                else:
+                    print('\033[91m' + f"Path not found: {path}" + '\033[0m')
+            # store the files that are still parsing
+            drain(wait_all=True)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(cancel_futures=True)
+            # always keep the manifest of what was done
+            manifest.save()
         # finally
+        if skipped_count:
+            print('\n\033[93m' + f"Skipped {skipped_count} unchanged files" + '\033[0m')
+        if removed_count:
+            print('\n\033[93m' + f"Removed {removed_count} stale items from \033[0m{name}")
         print('\n\033[92m' + f"Added {added_count} items to \033[0m{name}")
 
     # copy the path to settings file
@@ -219,6 +389,21 @@ class Brain:
         else:
             print('\033[91m' + "Missing SDB name"+ '\033[0m')
 
+    # convert an sdb to the current storage format
+    def handle_migrate (self, args: List[str]) -> str:
+        # use the given sdb or the current one
+        name = args[0] if len(args) > 0 else which_sdb()
+        if name == "":
+            print('\033[91m' + "SDB not selected, use: " + f'\033[0mker mv [SDB name]')
+            return
+        # check if it exists
+        if name not in os.listdir(main_path):
+            print('\033[91m' + "SDB " + '\033[0m' + name + '\033[91m' + " not found" + '\033[0m')
+            return
+        print('\033[92m' + "Migrating " + '\033[0m' + name + '\033[92m' + "..." + '\033[0m')
+        migrated = SDB(name).migrate()
+        print('\033[92m' + f"Migrated {migrated} items on \033[0m{name}")
+
 ################################################################################
 
     # start a chat with llm and embedding
@@ -233,6 +418,13 @@ class Brain:
         if name == "":
             print('\033[91m' + "SDB not selected, use: " + f'\033[0mker mv [SDB name]')
             return            
+        # get the filters of the search
+        args, flags = parse_flags(args, ["--source", "--pages", "--ntitle", "--links"])
+        try:
+            filters = parse_filters(flags)
+        except ValueError as e:
+            print('\033[91m' + f"Invalid filter: {e}" + '\033[0m')
+            return
         # then get the number of coincidences
         coincidences = int(os.environ["DEFAULT_COINCIDENCES"])
         # check if it was given
@@ -245,6 +437,7 @@ class Brain:
         # then start the db
         print('\033[92m' + "Embedding Chat on: \033[0m" + name + '\n')
         sdb = SDB(name)
+        warn_legacy_embeddings(sdb)
         # the config comes in sdb
 
         ######################## Chat section #########################
@@ -267,7 +460,7 @@ class Brain:
                 continue
             ###################### Answer part ##########################
             # then make the query
-            context = sdb.query(question, coincidences)
+            context = sdb.query(question, coincidences, **filters)
 
             # to answer without llm
             if not llm:
@@ -289,18 +482,79 @@ class Brain:
                 # prompt = prompt.replace("{*context}", "\n\n".join(context))
                 # then chat
                 print("\n\033[92m>>> Ker~$ \033[0m", end='')
-                print(chat(sdb.config["llm"], create_prompt(context, question, sdb.config)))
+                prompt = create_prompt(context, question, sdb.config)
+                # print the answer as it comes
+                for piece in chat_stream(sdb.config["llm_provider"], sdb.config["llm"], prompt, sdb.response_cache_version()):
+                    print(piece, end='', flush=True)
+                print()
                 print("\n")
 
 ################################################################################
 
-    # start the api
+    # start the api on the background, it serves every sdb
     def handle_start (self, args: List[str]) -> str:
-        return "on"
+        project_path = os.environ["PROJECT_PATH"]
+        host = os.environ.get("API_KEY_HOST", "0.0.0.0")
+        port = int(os.environ.get("API_KEY_PORT", "5000"))
+        pid_file = api_pid_file()
+        # only one ker run at a time checks and starts the api, so two
+        # of them can't start two servers on the same port
+        with open(pid_file + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            pid = api_pid()
+            if pid:
+                print('\033[93m' + f"API already running, pid {pid}" + '\033[0m')
+                return
+            if port_open(host, port):
+                print('\033[91m' + "Port already in use: " + '\033[0m' + f"{host}:{port}")
+                return
+            # the server output goes to a file
+            server_log = os.path.join(project_path, os.environ.get("API_SERVER_LOG", "api.out"))
+            output = open(server_log, 'a')
+            # on its own session, so it keeps running when the terminal closes
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(project_path, "api.py")],
+                cwd=project_path,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                start_new_session=True
+            )
+            output.close()
+            # the pid is written here, before the server imports anything
+            with open(pid_file + ".tmp", 'w') as f:
+                f.write(str(process.pid))
+            os.replace(pid_file + ".tmp", pid_file)
+        # wait until it takes connections, or it fails
+        deadline = time.time() + int(os.environ.get("API_START_TIMEOUT", 30))
+        while time.time() < deadline:
+            if process.poll() is not None:
+                # forget the pid of the dead process
+                api_pid()
+                print('\033[91m' + "API did not start, see " + '\033[0m' + server_log)
+                return
+            if port_open(host, port):
+                print('\033[92m' + "API running on " + '\033[0m' + f"{host}:{port}")
+                return
+            time.sleep(0.2)
+        print('\033[93m' + "API still starting, see " + '\033[0m' + server_log)
 
-    # stop an api
+    # stop the api, the requests in progress are finished first
     def handle_stop (self, args: List[str]) -> str:
-        return "on"
+        pid = api_pid()
+        if not pid:
+            print('\033[93m' + "API is not running" + '\033[0m')
+            return
+        print('\033[92m' + "Stopping API..." + '\033[0m')
+        signal_api(pid, signal.SIGTERM)
+        # wait the graceful shutdown of the server and its workers, then kill them
+        deadline = time.time() + int(os.environ.get("API_GRACEFUL_TIMEOUT", 30)) + 5
+        while time.time() < deadline:
+            if not api_pid() and not api_group_running(pid):
+                print('\033[92m' + "API stopped" + '\033[0m')
+                return
+            time.sleep(0.5)
+        signal_api(pid, signal.SIGKILL)
+        print('\033[91m' + "API did not stop in time, killed" + '\033[0m')
 
 
 if __name__ == "__main__":
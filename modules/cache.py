@@ -0,0 +1,343 @@
+import os
+import copy
+import time
+import array
+import atexit
+import numpy
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# cache dir shared by every sdb
+#  $CACHE_PATH
+#   |--- embeddings.sqlite3
+#   |--- responses.sqlite3
+
+def cache_path (filename: str) -> str:
+    # where the caches are stored, by default inside the collections
+    # dir as a hidden folder, so ker ls does not list it
+    path = os.environ.get("CACHE_PATH", os.path.join(os.environ["COLLECTIONS_PATH"], ".cache"))
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, filename)
+
+# hash used as key in the caches
+def content_key (*parts) -> str:
+    hash_obj = hashlib.sha256()
+    for part in parts:
+        # separate the parts so ("ab", "c") and ("a", "bc") differ
+        hash_obj.update(str(part).encode('utf-8'))
+        hash_obj.update(b'\0')
+    return hash_obj.hexdigest()
+
+
+# key-value cache stored on a sqlite file, values are bytes and the
+# least recently used entries are evicted when max_bytes is exceeded
+class DiskCache:
+    # reads only take the write lock of the file to update last_used
+    # in batches, every touch_seconds or touch_batch entries read. it's
+    # only used to choose what to evict, a late update doesn't matter
+    touch_seconds = 30
+    touch_batch = 1000
+    # the total size is kept on memory while putting, and read again
+    # every resync_seconds to count what other processes added
+    resync_seconds = 300
+
+    def __init__ (self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        # the same connection is shared by every thread
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # wal lets many processes (cli and api) share the file
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self.conn.commit()
+        # key -> time it was read, waiting to be written
+        self.touched = {}
+        self.touched_at = time.monotonic()
+        self._sync_total()
+        # what is pending is written when the process ends
+        atexit.register(self.flush)
+
+    def _sync_total (self):
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.synced_at = time.monotonic()
+
+    def get_many (self, keys: list) -> dict:
+        found = {}
+        if not keys:
+            return found
+        now = time.time()
+        with self.lock:
+            # sqlite limits the number of variables per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT key, value FROM cache WHERE key IN ({marks})", chunk)
+                found.update(rows.fetchall())
+            # and mark them as recently used, later
+            self.touched.update(dict.fromkeys(found, now))
+            if len(self.touched) >= self.touch_batch or time.monotonic() - self.touched_at >= self.touch_seconds:
+                self._write_touched()
+                self.conn.commit()
+        return found
+
+    def put_many (self, items: dict):
+        if not items:
+            return
+        now = time.time()
+        keys = list(items.keys())
+        with self.lock:
+            # size of the entries that are replaced
+            replaced = 0
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                replaced += self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM cache WHERE key IN ({marks})", chunk).fetchone()[0]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                [(key, value, len(value), now) for key, value in items.items()]
+            )
+            self.total += sum(len(value) for value in items.values()) - replaced
+            # a write is made anyway, the pending reads go with it
+            self._write_touched()
+            self._evict()
+            self.conn.commit()
+
+    def get (self, key: str):
+        return self.get_many([key]).get(key)
+
+    def put (self, key: str, value: bytes):
+        self.put_many({key: value})
+
+    # write the pending last_used (with self.lock taken)
+    def _write_touched (self):
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE cache SET last_used = MAX(last_used, ?) WHERE key = ?",
+                [(used, key) for key, used in self.touched.items()]
+            )
+            self.touched = {}
+        self.touched_at = time.monotonic()
+
+    def flush (self):
+        try:
+            with self.lock:
+                self._write_touched()
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing the cache {self.path}: {e}")
+
+    # remove the least recently used entries until the cache fits
+    def _evict (self):
+        if time.monotonic() - self.synced_at >= self.resync_seconds:
+            self._sync_total()
+        if self.total <= self.max_bytes:
+            return
+        # other processes may have evicted already, count it again
+        self._sync_total()
+        if self.total <= self.max_bytes:
+            return
+        # go from the oldest to the newest
+        to_free = self.total - self.max_bytes
+        rows = self.conn.execute("SELECT key, size FROM cache ORDER BY last_used")
+        stale = []
+        for key, size in rows:
+            if to_free <= 0:
+                break
+            stale.append((key,))
+            to_free -= size
+            self.total -= size
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", stale)
+
+
+# embeddings cache keyed by (provider, model, content hash), vectors
+# are stored as float32 arrays instead of json lists
+class EmbeddingCache (DiskCache):
+
+    def key (self, provider: str, model: str, text: str) -> str:
+        return content_key(provider, model, text)
+
+    def get_vectors (self, keys: list) -> dict:
+        vectors = {}
+        for key, value in self.get_many(keys).items():
+            vector = array.array('f')
+            vector.frombytes(value)
+            vectors[key] = vector.tolist()
+        return vectors
+
+    def put_vectors (self, vectors: dict):
+        self.put_many({key: array.array('f', vector).tobytes() for key, vector in vectors.items()})
+
+
+# one instance per process, created on first use
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache () -> EmbeddingCache:
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            max_mb = int(os.environ.get("EMBEDDING_CACHE_MAX_MB", 1024))
+            _embedding_cache = EmbeddingCache(cache_path("embeddings.sqlite3"), max_mb * 1024 * 1024)
+    return _embedding_cache
+
+
+# llm answers keyed by (provider, model, prompt, version), the version
+# changes with the sdb content and its config.json so old answers are
+# not reused. hits and misses are counted on memory and added to the
+# same file with the batched writes, so they add up across the cli and
+# the api
+class ResponseCache (DiskCache):
+    def __init__ (self, path: str, max_bytes: int):
+        # counts not written yet
+        self.counts = {"hits": 0, "misses": 0}
+        super().__init__(path, max_bytes)
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.conn.commit()
+
+    def key (self, provider: str, model: str, prompt: str, version) -> str:
+        return content_key(provider, model, prompt, version)
+
+    def get_text (self, key: str):
+        value = self.get(key)
+        with self.lock:
+            self.counts["hits" if value is not None else "misses"] += 1
+        return value.decode('utf-8') if value is not None else None
+
+    def put_text (self, key: str, text: str):
+        self.put(key, text.encode('utf-8'))
+
+    # the counts go with the last_used of the entries read
+    def _write_touched (self):
+        super()._write_touched()
+        pending = [(name, value) for name, value in self.counts.items() if value]
+        if pending:
+            self.conn.executemany(
+                "INSERT INTO stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", pending
+            )
+            self.counts = {"hits": 0, "misses": 0}
+
+    def stats (self) -> dict:
+        with self.lock:
+            rows = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            return {name: rows.get(name, 0) + self.counts[name] for name in ("hits", "misses")}
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache () -> ResponseCache:
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            max_mb = int(os.environ.get("RESPONSE_CACHE_MAX_MB", 256))
+            _response_cache = ResponseCache(cache_path("responses.sqlite3"), max_mb * 1024 * 1024)
+    return _response_cache
+
+
+# cache of query results kept in memory, entries expire after ttl
+# seconds, the least recently used go first when it's full, and they
+# are dropped when the version of the sdb changes (it was modified).
+# with similarity > 0 a query whose embedding is at least that similar
+# (cosine) to a cached one reuses its results
+class QueryCache:
+    def __init__ (self, max_entries: int = 256, ttl: float = 600, similarity: float = 0):
+        self.lock = threading.Lock()
+        # key -> (created, version, scope, embedding, results)
+        self.entries = OrderedDict()
+        self.configure(max_entries, ttl, similarity)
+
+    # change the settings, the entries that don't fit anymore are dropped
+    def configure (self, max_entries: int, ttl: float, similarity: float):
+        with self.lock:
+            self.max_entries = max_entries
+            self.ttl = ttl
+            self.similarity = similarity
+            self.settings = (max_entries, ttl, similarity)
+            while len(self.entries) > max(0, max_entries):
+                self.entries.popitem(last=False)
+
+    # same text with other casing, spaces or final punctuation
+    @staticmethod
+    def normalize (question: str) -> str:
+        return " ".join(question.lower().split()).strip("¿?¡!.,; ")
+
+    def _alive (self, entry, version) -> bool:
+        created, entry_version = entry[0], entry[1]
+        return entry_version == version and time.time() - created < self.ttl
+
+    def get (self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if not self._alive(entry, version):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return copy.deepcopy(entry[4])
+
+    # results of the most similar cached query on the same scope
+    def get_similar (self, scope, embedding, version):
+        if self.similarity <= 0 or embedding is None:
+            return None
+        query = numpy.asarray(embedding, dtype=numpy.float32)
+        query /= numpy.linalg.norm(query) or 1
+        with self.lock:
+            candidates = [
+                (key, entry) for key, entry in self.entries.items()
+                if entry[2] == scope and entry[3] is not None and self._alive(entry, version)
+            ]
+            if not candidates:
+                return None
+            scores = numpy.stack([entry[3] for _, entry in candidates]) @ query
+            best = int(numpy.argmax(scores))
+            if scores[best] < self.similarity:
+                return None
+            key, entry = candidates[best]
+            self.entries.move_to_end(key)
+            return copy.deepcopy(entry[4])
+
+    def put (self, key, scope, embedding, version, results):
+        if self.max_entries <= 0:
+            return
+        if embedding is not None:
+            # stored normalized, so the similarity is a dot product
+            embedding = numpy.asarray(embedding, dtype=numpy.float32)
+            embedding /= numpy.linalg.norm(embedding) or 1
+        with self.lock:
+            self.entries[key] = (time.time(), version, scope, embedding, copy.deepcopy(results))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# one query cache per sdb and process, with the settings of its
+# config.json. they are checked on every query, so a config reloaded
+# by a long running api applies right away
+_query_caches = {}
+_query_caches_lock = threading.Lock()
+
+def get_query_cache (name: str, config: dict) -> QueryCache:
+    settings = (
+        config.get("query_cache_size", 256),
+        config.get("query_cache_ttl", 600),
+        config.get("query_cache_similarity", 0)
+    )
+    with _query_caches_lock:
+        if name not in _query_caches:
+            _query_caches[name] = QueryCache(*settings)
+        elif _query_caches[name].settings != settings:
+            _query_caches[name].configure(*settings)
+    return _query_caches[name]
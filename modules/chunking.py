@@ -0,0 +1,86 @@
+import os
+import re
+import tiktoken  # Token counter
+from functools import lru_cache
+
+
+# Load the encoder only once per process
+@lru_cache(maxsize=None)
+def get_encoding (model="gpt-4o-mini"):
+    return tiktoken.encoding_for_model(model)
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    # https://platform.openai.com/tokenizer
+
+
+# Function to count tokens in a text
+def count_tokens (text):
+    # encode_ordinary does not fail on texts like <|endoftext|>
+    return len(get_encoding().encode_ordinary(text))
+
+
+# Function to split a text in pieces of at most max_tokens, returns
+# (piece, tokens) pairs. Sentences are tokenized once and words only
+# when a sentence alone does not fit
+def _pieces (content, max_tokens):
+    # Split by sentence endings
+    for sentence in re.split(r'(?<=\.)\s+', content):
+        if not sentence:
+            continue
+        # the leading space is how the sentence is counted once joined
+        tokens = count_tokens(" " + sentence)
+        if tokens <= max_tokens:
+            yield sentence, tokens
+        else:
+            # the sentence is too long, split by words
+            for word in sentence.split():
+                yield word, count_tokens(" " + word)
+
+
+# Function to split a chapter by token count
+def split_by_tokens (chapter, max_tokens=1000, overlap=None):
+    # tokens repeated from the end of a part at the start of the next
+    if overlap is None:
+        overlap = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 0))
+
+    # Build token-limited segments with a running count
+    parts = []
+    current = []  # (piece, tokens) of the part being built
+    current_tokens = 0
+    for piece, tokens in _pieces(chapter["content"], max_tokens):
+        if current and current_tokens + tokens > max_tokens:
+            parts.append(" ".join(p for p, _ in current))
+            # keep the tail of the part as overlap, as long as it
+            # leaves room for the new piece
+            kept = []
+            kept_tokens = 0
+            for p, t in reversed(current):
+                if kept_tokens + t > overlap or kept_tokens + t + tokens > max_tokens:
+                    break
+                kept.append((p, t))
+                kept_tokens += t
+            current = kept[::-1]
+            current_tokens = kept_tokens
+        current.append((piece, tokens))
+        current_tokens += tokens
+    if current:
+        parts.append(" ".join(p for p, _ in current))
+
+    # Create new chapters with updated titles and content
+    result = []
+    for idx, text in enumerate(parts):
+        new_chapter = chapter.copy()
+        new_chapter["title"] = f"{chapter.get('title', 'Chapter')} - part {idx + 1}"
+        new_chapter["content"] = text
+        result.append(new_chapter)
+    return result
+
+
+# Function to split long chapters
+def split_long_chapters (chapters, max_tokens=1000, overlap=None):
+    split_result = []
+    for ch in chapters:
+        if count_tokens(ch["content"]) > max_tokens:
+            split_result.extend(split_by_tokens(ch, max_tokens, overlap))
+        else:
+            split_result.append(ch)
+    return split_result
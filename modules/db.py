@@ -1,17 +1,26 @@
 import os
 import json
+import time
+import threading
 import ollama
 import hashlib
 import chromadb
 from tqdm import tqdm
+from itertools import batched
 
 # function to add ids and source to the documents
-from modules.extras import generate_id_and_source
-from modules.embeddings import make_embeddings
+from modules.extras import generate_id_and_source, elapsed_ms
+from modules.embeddings import make_embeddings, make_embeddings_batch
+from modules.lexical import LexicalIndex, reciprocal_rank_fusion
+from modules.cache import QueryCache, get_query_cache
 
 
 # collection
 #  |--- config.json
+#  |--- manifest.json
+#  |--- lexical.sqlite3
+#  |--- version          touched on every change of the chunks
+#  |--- db/
 #  |--- assets/
 #         |---- every file added ...
 
@@ -29,50 +38,355 @@ class SDB:
         # Get or create a collection with the given name
         self.collection = self.client.get_or_create_collection(name=name)
         # also load the config and the db dir
+        self.name = name
         self.dir = os.environ["COLLECTIONS_PATH"] + name + "/"
-        with open(self.dir + "config.json", 'r') as f:
-            self.config = json.load(f)
+        self.config_mtime = None
+        self.reload_config()
+        # and the lexical (bm25) index
+        self.lexical = LexicalIndex(self.dir)
+
+    # read the config.json again if it was modified since it was loaded
+    def reload_config (self):
+        mtime = os.stat(self.dir + "config.json").st_mtime_ns
+        if mtime != self.config_mtime:
+            with open(self.dir + "config.json", 'r') as f:
+                self.config = json.load(f)
+            self.config_mtime = mtime
+
+    # changes when the chunks or the config.json are modified, also by
+    # other processes, cached query results of older versions are dropped
+    def version (self):
+        stamps = []
+        for file in ("version", "config.json"):
+            try:
+                stamps.append(os.stat(self.dir + file).st_mtime_ns)
+            except FileNotFoundError:
+                stamps.append(0)
+        return tuple(stamps)
+
+    # version for llm.chat, only when the answers cache is on
+    def response_cache_version (self):
+        if not self.config.get("response_cache", False):
+            return None
+        return self.version()
+
+    def _touch_version (self):
+        with open(self.dir + "version", 'w') as f:
+            f.write(str(time.time_ns()))
+
+    # sdbs embedded with ollama before it moved to /api/embed don't
+    # have "legacy_embeddings": false on their config.json, they keep
+    # the old endpoint until ker migrate embeds them again
+    def legacy_embeddings (self) -> bool:
+        return self.config["embedding_provider"] == "Ollama" and self.config.get("legacy_embeddings", True)
+
+    def _embedding_provider (self) -> str:
+        return "OllamaLegacy" if self.legacy_embeddings() else self.config["embedding_provider"]
 
     def _generate_embeddings (self, text: str):
-        # use the preset model to make the embeddings
-        return make_embeddings(self.config["embedding"], text)
-
-    def add_documents (self, content: list):
-        # parameters for chromadb
-        embeddings = []
-        ids = []
-        docs = []
-        for doc in tqdm(content, desc="Embedding document"):
-            # add the embedding based on the document content
-            embeddings.append(self._generate_embeddings(doc["content"]))
-            # the id
-            ids.append(doc['id'])
-            # and the content
-            docs.append(json.dumps(doc, indent=4, ensure_ascii=False))
-        # check if any of the documents already exist
-        exist_first = self.collection.get(ids=ids[0])['documents']
-        exist_last = self.collection.get(ids=ids[-1])['documents']
-        # 
-        if exist_first and exist_last:
+        # use the preset provider and model to make the embeddings
+        return make_embeddings(self._embedding_provider(), self.config["embedding"], text)
+
+    def _generate_embeddings_batch (self, texts: list):
+        # batch size and concurrency come from the config.json
+        return make_embeddings_batch(
+            self._embedding_provider(),
+            self.config["embedding"],
+            texts,
+            batch_size=self.config.get("embedding_batch_size", 32),
+            concurrency=self.config.get("embedding_concurrency", 4)
+        )
+
+    # content can be a list or a generator of chunks, they are embedded
+    # and inserted in batches of insert_batch_size as they come
+    def add_documents (self, content):
+        added = 0
+        # ids already seen on this content
+        seen = set()
+        for batch in batched(content, self.config.get("insert_batch_size", 256)):
+            added += self._add_batch(batch, seen)
+        # everything was already on the sdb
+        if added == 0:
             print('\033[93m' + ">>> coincidence on SDB, skipping..." + '\033[0m\n')
+        return added
+
+    def _add_batch (self, batch, seen: set):
+        # drop repeated chunks inside the same content
+        unique = {}
+        for doc in batch:
+            if doc['id'] not in seen:
+                unique.setdefault(doc['id'], doc)
+        seen.update(unique)
+        if not unique:
+            return 0
+        # look up every id of the batch at once, only missing chunks are added
+        existing = set(self.collection.get(ids=list(unique.keys()), include=[])['ids'])
+        new_docs = [doc for doc_id, doc in unique.items() if doc_id not in existing]
+        if not new_docs:
             return 0
-        else:
-            # and add to collection
-            self.collection.add(ids=ids, documents=docs, embeddings=embeddings)
-            return len(ids)
+        # parameters for chromadb, the text is the document and the
+        # rest of the fields go as metadata
+        ids = [doc['id'] for doc in new_docs]
+        docs = [doc["content"] for doc in new_docs]
+        metadatas = [chunk_metadata(doc) for doc in new_docs]
+        # embed only the new documents in batches
+        embeddings = self._generate_embeddings_batch(docs)
+        # and add to collection
+        self.collection.add(ids=ids, documents=docs, metadatas=metadatas, embeddings=embeddings)
+        # keep the lexical index up to date
+        self.lexical.add(new_docs)
+        self._touch_version()
+        return len(ids)
+
+    def delete_documents (self, ids: list):
+        # nothing to delete
+        if not ids:
+            return 0
+        # a chunk repeated in a file has its id repeated
+        ids = list(dict.fromkeys(ids))
+        self.collection.delete(ids=ids)
+        self.lexical.delete(ids)
+        self._touch_version()
+        return len(ids)
+
+    # search the chunks that answer the query, mode is one of:
+    #   vector: embedding similarity
+    #   lexical: bm25 over the words, no embedding is made
+    #   hybrid: both merged with reciprocal rank fusion
+    # by default the "retrieval" of the config.json. filters are applied
+    # by chroma while searching, see build_where.
+    # results are cached per sdb, see QueryCache and the query_cache_*
+    # settings of the config.json, reuse by similarity is only made on
+    # vector mode and when query_cache_similarity > 0. with a timings
+    # dict, embed_ms, query_ms and query_cache (hit, similar or miss)
+    # are set on it
+    def query (self, query_text: str, n_results: int, source=None, pages=None, ntitle=None, links=None, mode=None, timings=None):
+        timings = {} if timings is None else timings
+        mode = mode or self.config.get("retrieval", "vector")
+        where = build_where(source, pages, ntitle, links)
+        cache = get_query_cache(self.name, self.config)
+        # read before searching, so a change made meanwhile drops the entry
+        version = self.version()
+        # queries with the same scope can share results by similarity
+        scope = (mode, n_results, json.dumps(where, sort_keys=True))
+        key = (QueryCache.normalize(query_text), *scope)
+        results = cache.get(key, version)
+        if results is not None:
+            timings["query_cache"] = "hit"
+            return results
+        # vector and hybrid need the embedding anyway
+        query_embedding = None
+        if mode != "lexical":
+            started = time.perf_counter()
+            query_embedding = self._generate_embeddings(query_text)
+            timings["embed_ms"] = elapsed_ms(started)
+        # similar questions can differ in the exact term (artículo 12 or
+        # 13) that lexical and hybrid search for, only vector reuses them
+        if mode == "vector":
+            results = cache.get_similar(scope, query_embedding, version)
+            if results is not None:
+                timings["query_cache"] = "similar"
+                return results
+        started = time.perf_counter()
+        results = self._search(query_text, query_embedding, n_results, where, mode)
+        timings["query_ms"] = elapsed_ms(started)
+        timings["query_cache"] = "miss"
+        cache.put(key, scope, query_embedding, version, results)
+        return results
 
-    def query (self, query_text: str, n_results: int):
+    def _search (self, query_text: str, query_embedding, n_results: int, where, mode: str):
+        if mode == "lexical":
+            return self._lexical_query(query_text, n_results, where)
+        if mode == "hybrid":
+            # more candidates from each side for the fusion
+            candidates = n_results * self.config.get("hybrid_candidates", 4)
+            return reciprocal_rank_fusion([
+                self._vector_query(query_text, candidates, where, query_embedding),
+                self._lexical_query(query_text, candidates, where)
+            ], n_results)
+        return self._vector_query(query_text, n_results, where, query_embedding)
+
+    def _vector_query (self, query_text: str, n_results: int, where=None, query_embedding=None):
         # make a query to the db
-        query_embedding = self._generate_embeddings(query_text)
+        if query_embedding is None:
+            query_embedding = self._generate_embeddings(query_text)
         # fetch results from the db
-        results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results)
+        results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results, where=where)
         # if there were not results
-        if 'documents' not in results:
+        if not results['ids']:
             return []
-        # else get the results
-        results = results['documents'][0]
-        # parse to json and return
-        return [json.loads(r.replace("'", "\"")) for r in results]
+        # else rebuild the chunks from the results
+        return [
+            chunk_from_record(doc_id, document, metadata)
+            for doc_id, document, metadata in zip(results['ids'][0], results['documents'][0], results['metadatas'][0])
+        ]
+
+    def _lexical_query (self, query_text: str, n_results: int, where=None):
+        chunks = []
+        offset = 0
+        # with filters some ids are dropped, so read pages of ids until
+        # there are enough chunks or the index has no more matches
+        page_size = n_results * 4 if where else n_results
+        while len(chunks) < n_results:
+            ids = self.lexical.search(query_text, page_size, offset)
+            if not ids:
+                break
+            offset += len(ids)
+            # get the chunks from chroma, applying the filters
+            records = self.collection.get(ids=ids, where=where, include=["documents", "metadatas"])
+            found = {
+                doc_id: chunk_from_record(doc_id, document, metadata)
+                for doc_id, document, metadata in zip(records['ids'], records['documents'], records['metadatas'])
+            }
+            # keep the bm25 order
+            chunks.extend(found[doc_id] for doc_id in ids if doc_id in found)
+            if len(ids) < page_size:
+                break
+        return chunks[:n_results]
+
+    # convert chunks stored as json documents to text and metadata,
+    # the embeddings are kept. chunks missing on the lexical index are
+    # indexed too. returns the number of chunks converted
+    def migrate (self, batch_size: int = 500):
+        migrated = 0
+        offset = 0
+        while True:
+            records = self.collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+            if not records['ids']:
+                break
+            offset += len(records['ids'])
+            ids, docs, metadatas, embeddings = [], [], [], []
+            chunks = []
+            for doc_id, document, metadata, embedding in zip(records['ids'], records['documents'], records['metadatas'], records['embeddings']):
+                chunk = chunk_from_record(doc_id, document, metadata)
+                chunks.append(chunk)
+                # already in the new format
+                if metadata:
+                    continue
+                ids.append(doc_id)
+                docs.append(chunk["content"])
+                metadatas.append(chunk_metadata(chunk))
+                embeddings.append(embedding)
+            if ids:
+                # the embeddings are passed again, without them chroma
+                # would embed the new documents with its default model
+                self.collection.update(ids=ids, documents=docs, metadatas=metadatas, embeddings=embeddings)
+                migrated += len(ids)
+                self._touch_version()
+            # the index skips the chunks it already has
+            self.lexical.add(chunks)
+        if self.legacy_embeddings():
+            migrated += self._reembed(batch_size)
+        return migrated
+
+    # embed every chunk again with /api/embed, then the config.json is
+    # marked so the queries use it too. returns the chunks embedded
+    def _reembed (self, batch_size: int):
+        self.config["legacy_embeddings"] = False
+        embedded = 0
+        offset = 0
+        while True:
+            records = self.collection.get(include=["documents"], limit=batch_size, offset=offset)
+            if not records['ids']:
+                break
+            offset += len(records['ids'])
+            embeddings = self._generate_embeddings_batch(records['documents'])
+            self.collection.update(ids=records['ids'], embeddings=embeddings)
+            embedded += len(records['ids'])
+        with open(self.dir + "config.json", 'w') as f:
+            json.dump(self.config, f, indent=4, ensure_ascii=False)
+        self._touch_version()
+        return embedded
+
+
+# open sdbs of the process, every collection has a single chroma
+# client shared by the requests of the api
+_sdbs = {}
+_sdbs_lock = threading.Lock()
+
+def get_sdb (name: str) -> SDB:
+    with _sdbs_lock:
+        sdb = _sdbs.get(name)
+        if sdb is None:
+            # SDB would create the folders of a missing collection
+            if not os.path.exists(os.path.join(os.environ["COLLECTIONS_PATH"], name, "config.json")):
+                raise FileNotFoundError(f"Collection '{name}' not found")
+            sdb = _sdbs[name] = SDB(name)
+    # pick up changes made with ker set
+    try:
+        sdb.reload_config()
+    except FileNotFoundError:
+        # the collection was removed
+        with _sdbs_lock:
+            _sdbs.pop(name, None)
+        raise FileNotFoundError(f"Collection '{name}' not found")
+    return sdb
+
+
+# fields of a chunk stored as chroma metadata, chroma only takes
+# str, int, float and bool so pages go as page_start and page_end
+def chunk_metadata (doc: dict) -> dict:
+    metadata = {
+        "title": str(doc.get("title", "")),
+        "source": str(doc.get("source", "")),
+        "filename": os.path.basename(str(doc.get("source", ""))),
+        "ntitle": int(doc.get("ntitle", 0)),
+        "links": bool(doc.get("links", False))
+    }
+    # pdfs have [first, last] pages, pptx only the slide number
+    pages = doc.get("pages")
+    if isinstance(pages, (list, tuple)) and pages:
+        metadata["page_start"] = int(pages[0])
+        metadata["page_end"] = int(pages[-1])
+    elif isinstance(pages, int):
+        metadata["page_start"] = metadata["page_end"] = pages
+    return metadata
+
+# build the chroma where clause for the query filters:
+#   source: file name or path of the source, or a list of them
+#   pages: (first, last) range, chunks with any page in it match
+#   ntitle: heading level, or a list of them
+#   links: True or False, if the chunk has links
+def build_where (source=None, pages=None, ntitle=None, links=None):
+    conditions = []
+    if source:
+        sources = [source] if isinstance(source, str) else list(source)
+        # match the whole path as it was added or only the file name
+        conditions.append({"$or": [{"source": {"$in": sources}}, {"filename": {"$in": sources}}]})
+    if pages:
+        first, last = pages
+        conditions.append({"page_start": {"$lte": int(last)}})
+        conditions.append({"page_end": {"$gte": int(first)}})
+    if ntitle is not None:
+        levels = [ntitle] if isinstance(ntitle, int) else list(ntitle)
+        conditions.append({"ntitle": {"$in": [int(level) for level in levels]}})
+    if links is not None:
+        conditions.append({"links": bool(links)})
+    # chroma needs $and only with more than one condition
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+# rebuild a chunk from what chroma returns
+def chunk_from_record (doc_id: str, document: str, metadata: dict) -> dict:
+    # chunks added before the metadata were the whole chunk as json
+    if not metadata:
+        chunk = json.loads(document)
+        chunk["id"] = doc_id
+        return chunk
+    chunk = {
+        "id": doc_id,
+        "title": metadata.get("title", ""),
+        "content": document,
+        "ntitle": metadata.get("ntitle", 0),
+        "links": metadata.get("links", False),
+        "source": metadata.get("source", "")
+    }
+    if "page_start" in metadata:
+        chunk["pages"] = [metadata["page_start"], metadata["page_end"]]
+    return chunk
 
 
 # function to create db
@@ -1,22 +1,63 @@
-# from openai import OpenAI
+import asyncio
+from tqdm import tqdm
 
-# client = OpenAI()
+from modules.cache import get_embedding_cache
+from modules.providers import get_provider, run
 
-# def make_embeddings (model: str, text: str) -> list:
-#     # make the embeddings
-#     respuesta = client.embeddings.create(
-#         input=text,
-#         model=model
-#     )
-#     # return the embeddings and the usage
-#     return respuesta.data[0].embedding# , respuesta["usage"]
 
 
-import ollama
+# the provider is the embedding_provider of the config.json, one of
+# modules.providers.providers: OpenAI, Ollama, OllamaLegacy or Local
+def make_embeddings (provider: str, model: str, text: str) -> list:
+    # a single text is just a batch of one, this way queries and
+    # documents are embedded through the same endpoint
+    return make_embeddings_batch(provider, model, [text], progress=False)[0]
 
-def make_embeddings (model: str, text: str) -> list:
-    response = ollama.embeddings(
-        model=model,
-        prompt=text
-    )
-    return response['embedding']
\ No newline at end of file
+# embed many texts sending batch_size texts per request, keeping at
+# most concurrency requests in flight, results come in the same order.
+# texts already embedded are taken from the embeddings cache
+def make_embeddings_batch (provider: str, model: str, texts: list, batch_size: int = 32, concurrency: int = 4, progress: bool = True) -> list:
+    # nothing to embed
+    if not texts:
+        return []
+    # look for the texts in the cache
+    cache = get_embedding_cache()
+    keys = [cache.key(provider, model, text) for text in texts]
+    cached = cache.get_vectors(list(set(keys)))
+    # only embed the missing ones, once each
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached:
+            missing[key] = text
+    if missing:
+        vectors = _embed(provider, model, list(missing.values()), batch_size, concurrency, progress)
+        new = dict(zip(missing.keys(), vectors))
+        cache.put_vectors(new)
+        cached.update(new)
+    return [cached[key] for key in keys]
+
+# make the requests to the provider
+def _embed (provider: str, model: str, texts: list, batch_size: int, concurrency: int, progress: bool) -> list:
+    # split the texts in batches
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    return run(_embed_batches(provider, model, batches, concurrency, progress))
+
+# every batch is one request, at most concurrency of them in flight
+# (and the provider keeps its own limit for the whole process)
+async def _embed_batches (provider: str, model: str, batches: list, concurrency: int, progress: bool) -> list:
+    embedder = get_provider(provider)
+    limit = asyncio.Semaphore(max(1, concurrency))
+    bar = tqdm(total=len(batches), desc="Embedding document", disable=not progress)
+
+    async def embed_batch (batch):
+        async with limit:
+            embeddings = await embedder.embed(model, batch)
+        bar.update(1)
+        return embeddings
+
+    try:
+        # gather keeps the order of the batches
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    finally:
+        bar.close()
+    return [embedding for batch_embeddings in results for embedding in batch_embeddings]
@@ -1,6 +1,8 @@
 import os
-import random
+import time
 import hashlib
+from fnmatch import fnmatch
+from concurrent.futures import Executor, Future
 
 # used to read the flag file that indicates the curren sdb
 def which_sdb ():
@@ -16,14 +18,37 @@ def move_to_sdb (name):
     with open(os.environ["FLAG_SDB_NAME"], 'w') as f:
         f.write(name)
 
+# pid of the api server if it's running, the pid file left by a
+# server that did not exit cleanly is removed
+def api_pid_file ():
+    return os.path.join(os.environ["PROJECT_PATH"], os.environ.get("API_PID_FILE", "api.pid"))
+
+def api_pid ():
+    pid_file = api_pid_file()
+    try:
+        with open(pid_file, 'r') as f:
+            pid = int(f.read().strip())
+        # signal 0 only checks that the process exists
+        os.kill(pid, 0)
+        return pid
+    except FileNotFoundError:
+        return None
+    except (ValueError, ProcessLookupError):
+        os.remove(pid_file)
+        return None
+
+# milliseconds since a time.perf_counter() start, for the timings
+def elapsed_ms (started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
 # function to generate hashes of a dicts
 def hashx (string):
     hash_obj = hashlib.sha256()
     # convert the string to bytes and hash
     hash_obj.update(string.encode('utf-8'))
-    # get the hex
-    return str(hash_obj.hexdigest())[:random.randint(32, 128)]
-    # return str(hash_obj.hexdigest())[:128]
+    # get the hex, always the full digest so the same
+    # content gets the same id on every run
+    return str(hash_obj.hexdigest())
 
 # function to generate the ids based on content
 def generate_id_and_source (documents, source):
@@ -34,4 +59,119 @@ def generate_id_and_source (documents, source):
         # generate an id based on the content
         doc['id'] = hashx(doc["content"] + doc["title"] + doc["source"])
     # and return documents
-    return documents
\ No newline at end of file
+    return documents
+
+# same as generate_id_and_source, one document at a time
+def iter_id_and_source (documents, source):
+    for doc in documents:
+        yield generate_id_and_source([doc], source)[0]
+
+# split the args in positional ones and --flag value pairs, a flag
+# can be given many times so its values come in a list
+def parse_flags (args, flags):
+    positional = []
+    values = {flag: [] for flag in flags}
+    i = 0
+    while i < len(args):
+        if args[i] in values and i + 1 < len(args):
+            values[args[i]].append(args[i + 1])
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, values
+
+# convert sizes like 500K, 20M or 1G to bytes
+def parse_size (size):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+# convert the --source, --pages, --ntitle and --links flags of the
+# chats to the filters of SDB.query, raises ValueError if invalid
+def parse_filters (flags):
+    filters = {}
+    if flags.get("--source"):
+        filters["source"] = flags["--source"]
+    if flags.get("--pages"):
+        # a range 10-20 (or 20-10) or a single page
+        first, dash, last = flags["--pages"][-1].partition("-")
+        if not first.strip() or (dash and not last.strip()):
+            raise ValueError("--pages must be a page or a range like 10-20")
+        first, last = int(first), int(last or first)
+        filters["pages"] = (min(first, last), max(first, last))
+    if flags.get("--ntitle"):
+        filters["ntitle"] = [int(level) for level in flags["--ntitle"]]
+    if flags.get("--links"):
+        value = flags["--links"][-1].lower()
+        if value not in ("yes", "no", "true", "false"):
+            raise ValueError("--links must be yes or no")
+        filters["links"] = value in ("yes", "true")
+    return filters
+
+# check a path against glob patterns, on the whole relative path or the name
+def matches_any (rel_path, patterns):
+    name = os.path.basename(rel_path)
+    return any(fnmatch(rel_path, p) or fnmatch(name, p) for p in patterns)
+
+# walk a folder tree and yield the files as they are found, paths are
+# yielded joined to the given folder. hidden files and folders are skipped,
+# exclude patterns also prune folders, include patterns only apply to files.
+# symlinked folders are followed once, a link back to a folder already
+# visited (a loop or a second path to it) is skipped
+def walk_files (folder, base_dir="", include=None, exclude=None, max_size=None):
+    include = include or []
+    exclude = exclude or []
+    # folders left to visit, as paths relative to the walked folder
+    stack = [""]
+    # (device, inode) of the folders already found
+    visited = set()
+    try:
+        root = os.stat(os.path.join(base_dir, folder))
+        visited.add((root.st_dev, root.st_ino))
+    except OSError:
+        pass
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(base_dir, folder, rel_dir))
+        except OSError as e:
+            print('\033[91m' + f"Can't read folder {os.path.join(folder, rel_dir)}:" + '\033[0m', e)
+            continue
+        with entries:
+            # sorted to always visit the files in the same order
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.name.startswith("."):
+                    continue
+                rel_path = os.path.join(rel_dir, entry.name)
+                if matches_any(rel_path, exclude):
+                    continue
+                try:
+                    if entry.is_dir():
+                        stat = entry.stat()
+                        if (stat.st_dev, stat.st_ino) in visited:
+                            continue
+                        visited.add((stat.st_dev, stat.st_ino))
+                        stack.append(rel_path)
+                    elif entry.is_file():
+                        if include and not matches_any(rel_path, include):
+                            continue
+                        if max_size is not None and entry.stat().st_size > max_size:
+                            continue
+                        yield os.path.join(folder, rel_path)
+                # broken or looping links, files removed while walking
+                except OSError as e:
+                    print('\033[91m' + f"Can't read {os.path.join(folder, rel_path)}:" + '\033[0m', e)
+
+# executor that runs the tasks right away on the same process, used
+# when a pool is not worth it (one worker, debugging)
+class InlineExecutor (Executor):
+    def submit (self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
@@ -0,0 +1,83 @@
+import os
+import re
+import sqlite3
+import threading
+
+
+# lexical index of an sdb, an sqlite fts5 table ranked with bm25
+#  collection
+#   |--- lexical.sqlite3
+#
+# sqlite reads the file through mmap (LEXICAL_MMAP_MB) so lookups
+# stay fast on big collections without loading the index in memory
+
+class LexicalIndex:
+    def __init__ (self, sdb_dir: str):
+        self.path = os.path.join(sdb_dir, "lexical.sqlite3")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        mmap_bytes = int(os.environ.get("LEXICAL_MMAP_MB", 256)) * 1024 * 1024
+        self.conn.execute(f"PRAGMA mmap_size={mmap_bytes}")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # chunk ids, their rowid is the rowid on the fts table
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL)")
+        # remove_diacritics so "articulo" matches "artículo"
+        self.conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5("
+            "title, content, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        self.conn.commit()
+
+    # add chunks to the index, chunks already indexed are skipped
+    def add (self, docs: list):
+        with self.lock:
+            for doc in docs:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO chunks (id) VALUES (?)", (doc["id"],))
+                # it was already there
+                if cursor.rowcount == 0:
+                    continue
+                self.conn.execute(
+                    "INSERT INTO terms (rowid, title, content) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, doc.get("title", ""), doc["content"])
+                )
+            self.conn.commit()
+
+    def delete (self, ids: list):
+        with self.lock:
+            for doc_id in ids:
+                row = self.conn.execute("SELECT rowid FROM chunks WHERE id = ?", (doc_id,)).fetchone()
+                if row is None:
+                    continue
+                self.conn.execute("DELETE FROM terms WHERE rowid = ?", row)
+                self.conn.execute("DELETE FROM chunks WHERE rowid = ?", row)
+            self.conn.commit()
+
+    # ids of the chunks that best match the words of the text, best first
+    def search (self, text: str, limit: int, offset: int = 0) -> list:
+        # every word is quoted so fts5 does not read it as syntax
+        words = re.findall(r'\w+', text.lower())
+        if not words:
+            return []
+        match = " OR ".join(f'"{word}"' for word in dict.fromkeys(words))
+        with self.lock:
+            rows = self.conn.execute(
+                # bm25 is lower for better matches, titles weigh double
+                "SELECT chunks.id FROM terms JOIN chunks ON chunks.rowid = terms.rowid "
+                "WHERE terms MATCH ? ORDER BY bm25(terms, 2.0, 1.0) LIMIT ? OFFSET ?",
+                (match, limit, offset)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+# merge rankings of chunks, every chunk scores 1 / (k + rank) on each
+# ranking where it appears, https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+def reciprocal_rank_fusion (rankings: list, n_results: int, k: int = 60) -> list:
+    scores = {}
+    chunks = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking):
+            scores[chunk["id"]] = scores.get(chunk["id"], 0) + 1 / (k + rank + 1)
+            chunks.setdefault(chunk["id"], chunk)
+    best = sorted(scores, key=scores.get, reverse=True)[:n_results]
+    return [chunks[chunk_id] for chunk_id in best]
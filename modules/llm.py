@@ -1,37 +1,64 @@
-from openai import OpenAI
-import ollama
+from modules.cache import get_response_cache
+from modules.providers import providers, get_provider, run, iterate
 
-# instance openAI client
-client = OpenAI()
+# available providers, some only make embeddings
+available_providers = [name for name, provider in providers.items() if provider.can_chat]
 
-# available providers
-available_providers = ["OpenAI", "Ollama"]
 
+# general function to chat, with a cache_version the answer is cached
+# for that version (see SDB.version), None to always call the provider.
+# with a timings dict, response_cache (hit or miss) is set on it
+def chat (provider: str, model: str, prompt: str, cache_version=None, timings=None):
+  # if provider was not found
+  if provider not in available_providers:
+    raise ValueError(f"{provider} not available, only: {available_providers}")
+
+  # look for the same prompt already answered
+  if cache_version is not None:
+    cache = get_response_cache()
+    key = cache.key(provider, model, prompt, cache_version)
+    answer = cache.get_text(key)
+    if timings is not None:
+      timings["response_cache"] = "miss" if answer is None else "hit"
+    if answer is None:
+      answer = _chat(provider, model, prompt)
+      cache.put_text(key, answer)
+    return answer
 
-# general function to chat
-def chat (provider: str, model: str, prompt: str):
+  return _chat(provider, model, prompt)
+
+
+# same as chat but yields the answer in pieces as the provider sends
+# them. a cached answer comes in a single piece, a new one is cached
+# only once it was received completely
+def chat_stream (provider: str, model: str, prompt: str, cache_version=None, timings=None):
   # if provider was not found
   if provider not in available_providers:
-    raise ValueError(f"{privider} not available, only: {available_providers}")
-
-  #
-  if provider == "OpenAI":
-    # chat with OpenAI
-    completion = client.chat.completions.create(
-      model=model,
-      messages=[
-        {"role": "user","content": prompt}
-      ]
-    )
-    # and return message
-    return completion.choices[0].message.content
-
-  # 
-  if provider == "Ollama"
-    response = ollama.chat(
-      model=model,
-      messages=[
-        {"role": "user", "content": prompt}
-      ]
-    )
-    return response['message']['content']
\ No newline at end of file
+    raise ValueError(f"{provider} not available, only: {available_providers}")
+
+  if cache_version is None:
+    yield from _chat_stream(provider, model, prompt)
+    return
+
+  cache = get_response_cache()
+  key = cache.key(provider, model, prompt, cache_version)
+  answer = cache.get_text(key)
+  if timings is not None:
+    timings["response_cache"] = "miss" if answer is None else "hit"
+  if answer is not None:
+    yield answer
+    return
+  parts = []
+  for piece in _chat_stream(provider, model, prompt):
+    parts.append(piece)
+    yield piece
+  cache.put_text(key, "".join(parts))
+
+
+# the providers are async, see modules/providers.py
+def _chat (provider: str, model: str, prompt: str):
+  return run(get_provider(provider).chat(model, prompt))
+
+
+def _chat_stream (provider: str, model: str, prompt: str):
+  yield from iterate(get_provider(provider).chat_stream(model, prompt))
@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+
+
+# manifest of the files added to an sdb
+#  collection
+#   |--- manifest.json
+#
+# {
+#     "files": {
+#         "/full/path/to/file.pdf": {
+#             "source": "file.pdf",
+#             "size": 1024,
+#             "mtime": 1718000000.0,
+#             "hash": "sha256 of the file",
+#             "chunks": ["chunk ids", ...],
+#             "added_at": "2024-06-10T12:00:00"
+#         }
+#     }
+# }
+
+# hash of a file content, read by blocks to not load it all
+def file_hash (path: str) -> str:
+    hash_obj = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hash_obj.update(block)
+    return hash_obj.hexdigest()
+
+
+class Manifest:
+    def __init__ (self, sdb_dir: str):
+        self.path = os.path.join(sdb_dir, "manifest.json")
+        # load the manifest if it exists
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.files = json.load(f)["files"]
+        else:
+            self.files = {}
+
+    def get (self, path: str):
+        return self.files.get(path)
+
+    # check if the file is the same that was added, size and mtime
+    # are compared first, the content only when they changed. returns
+    # (unchanged, hash), the hash is None if the file was not read. the
+    # hash is taken with the stat, before parsing, so a file modified
+    # while it's parsed does not look unchanged on the next add
+    def check (self, path: str, stat: os.stat_result):
+        entry = self.files.get(path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True, None
+        hash = file_hash(path)
+        # the file was touched, compare the content
+        if entry is not None and entry["size"] == stat.st_size and entry["hash"] == hash:
+            # remember the new mtime to not hash it again
+            entry["mtime"] = stat.st_mtime
+            return True, hash
+        return False, hash
+
+    def update (self, path: str, source: str, stat: os.stat_result, chunks: list, hash: str):
+        self.files[path] = {
+            "source": source,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": hash,
+            "chunks": chunks,
+            "added_at": datetime.now().isoformat()
+        }
+
+    def remove (self, path: str):
+        return self.files.pop(path, None)
+
+    # files of the manifest that are inside a folder
+    def files_under (self, folder: str) -> list:
+        folder = os.path.join(folder, "")
+        return [path for path in self.files if path.startswith(folder)]
+
+    def save (self):
+        # write to a temp file and replace, never leave a half written manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"files": self.files}, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -1,3 +1,5 @@
+import re
+from modules.chunking import count_tokens
 
 
 # context is what db found
@@ -8,17 +10,86 @@ def create_prompt (context, question, config):
 	prompt = "\n".join(config["prompt"])
 	# insert the user question
 	prompt = prompt.replace("{*question}", question)
-	# 
-	context_str = ""
-	for c in context:
-		context_str += "\n"
-		context_str += c["content"]
-		context_str += "\n"
-		# if the content has pages (comes from a pdf, pptx or docx)
-		if "pages" in c:
-			context_str += "Páginas: " + str(c["pages"]) + ". "
-		context_str += "Fuente: " + c["source"]
-		context_str += "\n"
-	# and the context from the db
+	# and the context from the db, fitted in the token budget
+	context_str = build_context(
+		context,
+		config.get("context_tokens", 6000),
+		config.get("dedupe_similarity", 0.9)
+	)
 	prompt = prompt.replace("{*context}", context_str)
-	return prompt
\ No newline at end of file
+	return prompt
+
+
+# first and last page of a chunk, None if it has no pages
+def page_range (chunk):
+	pages = chunk.get("pages")
+	if isinstance(pages, (list, tuple)) and pages:
+		return int(pages[0]), int(pages[-1])
+	if isinstance(pages, int):
+		return pages, pages
+	return None
+
+# words of a chunk, to compare it with others
+def word_set (text):
+	return set(re.findall(r'\w+', text.lower()))
+
+# jaccard similarity of two word sets
+def similarity (a, b):
+	if not a and not b:
+		return 1.0
+	return len(a & b) / len(a | b)
+
+
+# line with the pages and source of a block
+def block_footer (pages, source):
+	# if the content has pages (comes from a pdf, pptx or docx)
+	if pages:
+		return "Páginas: " + str(list(pages)) + ". Fuente: " + source
+	return "Fuente: " + source
+
+# text of a block of chunks, with its pages and source
+def format_block (block):
+	# the chunks of a block go in page order
+	content = "\n".join(text for _, text in sorted(block["contents"], key=lambda p: p[0]))
+	return "\n" + content + "\n" + block_footer(block["pages"], block["source"]) + "\n"
+
+
+# assemble the context from the chunks, best ranked first, until
+# max_tokens are used. chunks almost equal (dedupe_similarity) to one
+# already taken from the same source are dropped, and chunks of the
+# same source with overlapping or consecutive pages are merged in a
+# single block, so the source is written once
+def build_context (context, max_tokens, dedupe_similarity=0.9):
+	blocks = []
+	taken = []  # (source, words) of the chunks already in
+	used = 0
+	for c in context:
+		source = c.get("source", "")
+		words = word_set(c["content"])
+		# near duplicates from the same source
+		if any(s == source and similarity(w, words) >= dedupe_similarity for s, w in taken):
+			continue
+		pages = page_range(c)
+		# the block where it goes, if there's one next to its pages
+		block = None
+		if pages:
+			for b in blocks:
+				if b["source"] == source and b["pages"] and pages[0] <= b["pages"][1] + 1 and b["pages"][0] <= pages[1] + 1:
+					block = b
+					break
+		# tokens are counted once per chunk, plus its pages and source
+		# line when it starts a new block
+		tokens = count_tokens(c["content"])
+		if block is None:
+			tokens += count_tokens(block_footer(pages, source))
+		if used + tokens > max_tokens:
+			# it does not fit, but a smaller one still may
+			continue
+		used += tokens
+		taken.append((source, words))
+		if block is None:
+			blocks.append({"source": source, "pages": pages, "contents": [(pages[0] if pages else 0, c["content"])]})
+		else:
+			block["contents"].append((pages[0], c["content"]))
+			block["pages"] = (min(block["pages"][0], pages[0]), max(block["pages"][1], pages[1]))
+	return "".join(format_block(b) for b in blocks)
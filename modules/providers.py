@@ -0,0 +1,311 @@
+import os
+import random
+import asyncio
+import threading
+
+import httpx
+import numpy
+import ollama
+import openai
+
+
+# async clients for the llm and embeddings providers. every provider
+# has one client per process, so the http connections are reused, and
+# a semaphore that bounds its requests in flight. the coroutines run on
+# an event loop in a background thread, the sync code calls them with
+# run() and iterate()
+#
+# settings (global.conf):
+#   PROVIDER_TIMEOUT      seconds for a request, or between stream pieces
+#   PROVIDER_RETRIES      retries of a failed request, with backoff
+#   PROVIDER_BACKOFF      seconds before the first retry, doubled each time
+#   OPENAI_CONCURRENCY    requests in flight to OpenAI
+#   OLLAMA_CONCURRENCY    requests in flight to Ollama
+#   LOCAL_CONCURRENCY     batches embedded at once by the local models
+
+class Provider:
+    name = ""
+    # providers that only make embeddings set it to False
+    can_chat = True
+
+    def __init__ (self):
+        self.timeout = float(os.environ.get("PROVIDER_TIMEOUT", 120))
+        self.retries = int(os.environ.get("PROVIDER_RETRIES", 3))
+        self.backoff = float(os.environ.get("PROVIDER_BACKOFF", 0.5))
+        concurrency = int(os.environ.get(f"{self.name.upper()}_CONCURRENCY", 8))
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._client = None
+
+    # the client is created on first use, inside the event loop
+    @property
+    def client (self):
+        if self._client is None:
+            self._client = self.make_client()
+        return self._client
+
+    def make_client (self):
+        raise NotImplementedError
+
+    # errors worth another try: timeouts, lost connections, rate limits
+    # and server errors
+    def retryable (self, error: Exception) -> bool:
+        return isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError))
+
+    # make a request with the concurrency limit, timeout and retries
+    async def call (self, request):
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    return await asyncio.wait_for(request(), self.timeout)
+            except Exception as e:
+                if attempt >= self.retries or not self.retryable(e):
+                    raise
+            await asyncio.sleep(self.backoff_delay(attempt))
+            attempt += 1
+
+    # exponential backoff with some jitter, so clients that failed
+    # together do not retry together
+    def backoff_delay (self, attempt: int) -> float:
+        return self.backoff * 2 ** attempt * (1 + random.random())
+
+    async def chat (self, model: str, prompt: str) -> str:
+        raise NotImplementedError
+
+    async def chat_stream (self, model: str, prompt: str):
+        raise NotImplementedError
+
+    async def embed (self, model: str, texts: list) -> list:
+        raise NotImplementedError
+
+    # read a stream with the timeout between pieces, it keeps a slot
+    # of the semaphore until it ends. opening it, up to its first
+    # piece, is retried like call(), once text was given it can't be
+    async def _read_stream (self, open_stream, piece_text):
+        attempt = 0
+        while True:
+            await self.semaphore.acquire()
+            try:
+                stream = await asyncio.wait_for(open_stream(), self.timeout)
+                iterator = aiter(stream)
+                chunk = await asyncio.wait_for(anext(iterator), self.timeout)
+                break
+            except StopAsyncIteration:
+                self.semaphore.release()
+                return
+            except Exception as e:
+                self.semaphore.release()
+                if attempt >= self.retries or not self.retryable(e):
+                    raise
+            await asyncio.sleep(self.backoff_delay(attempt))
+            attempt += 1
+        try:
+            while True:
+                text = piece_text(chunk)
+                if text:
+                    yield text
+                try:
+                    chunk = await asyncio.wait_for(anext(iterator), self.timeout)
+                except StopAsyncIteration:
+                    break
+        finally:
+            self.semaphore.release()
+
+
+class OpenAIProvider (Provider):
+    name = "OpenAI"
+
+    def make_client (self):
+        # the retries are made by call, not by the client
+        return openai.AsyncOpenAI(timeout=self.timeout, max_retries=0)
+
+    def retryable (self, error: Exception) -> bool:
+        return super().retryable(error) or isinstance(
+            error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+        )
+
+    async def chat (self, model: str, prompt: str) -> str:
+        completion = await self.call(lambda: self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}]
+        ))
+        return completion.choices[0].message.content
+
+    async def chat_stream (self, model: str, prompt: str):
+        def open_stream ():
+            return self.client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True
+            )
+        # the last chunk can come without choices or content
+        def piece_text (chunk):
+            return chunk.choices[0].delta.content if chunk.choices else None
+        async for text in self._read_stream(open_stream, piece_text):
+            yield text
+
+    async def embed (self, model: str, texts: list) -> list:
+        response = await self.call(lambda: self.client.embeddings.create(model=model, input=texts))
+        # the data comes with the index of each text
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class OllamaProvider (Provider):
+    name = "Ollama"
+
+    def make_client (self):
+        # the host is taken from OLLAMA_HOST
+        return ollama.AsyncClient(timeout=self.timeout)
+
+    def retryable (self, error: Exception) -> bool:
+        if isinstance(error, ollama.ResponseError):
+            return error.status_code == 429 or error.status_code >= 500
+        return super().retryable(error)
+
+    async def chat (self, model: str, prompt: str) -> str:
+        response = await self.call(lambda: self.client.chat(
+            model=model,
+            messages=[{"role": "user", "content": prompt}]
+        ))
+        return response['message']['content']
+
+    async def chat_stream (self, model: str, prompt: str):
+        async def open_stream ():
+            return await self.client.chat(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True
+            )
+        async for text in self._read_stream(open_stream, lambda chunk: chunk['message']['content']):
+            yield text
+
+    async def embed (self, model: str, texts: list) -> list:
+        response = await self.call(lambda: self.client.embed(model=model, input=texts))
+        return response['embeddings']
+
+
+# the /api/embeddings endpoint of ollama, used before /api/embed: one
+# text per request and the vectors are not normalized. sdbs embedded
+# with it keep using it, so their queries match the stored vectors,
+# until ker migrate embeds them again with /api/embed
+class OllamaLegacyProvider (OllamaProvider):
+    can_chat = False
+
+    async def embed (self, model: str, texts: list) -> list:
+        responses = await asyncio.gather(*(
+            self.call(lambda text=text: self.client.embeddings(model=model, prompt=text))
+            for text in texts
+        ))
+        return [response['embedding'] for response in responses]
+
+
+# embeddings made on this process by an onnx sentence transformer, on
+# cpu and without network. the model of the config.json is a folder
+# (absolute or inside LOCAL_MODELS_PATH) with the exported model.onnx
+# and its tokenizer.json
+class LocalProvider (Provider):
+    name = "Local"
+    can_chat = False
+
+    def __init__ (self):
+        super().__init__()
+        self.models = {}
+        self.models_lock = threading.Lock()
+
+    # onnx session and tokenizer of a model, loaded once
+    def load (self, model: str):
+        with self.models_lock:
+            if model not in self.models:
+                # imported here, only installs with local models need them
+                import onnxruntime
+                from tokenizers import Tokenizer
+                folder = os.path.join(os.environ.get("LOCAL_MODELS_PATH", ""), model)
+                tokenizer = Tokenizer.from_file(os.path.join(folder, "tokenizer.json"))
+                tokenizer.enable_truncation(max_length=int(os.environ.get("LOCAL_MAX_TOKENS", 512)))
+                # pad each batch to its longest text
+                tokenizer.enable_padding()
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = int(os.environ.get("LOCAL_THREADS", 0))
+                session = onnxruntime.InferenceSession(
+                    os.path.join(folder, "model.onnx"), options, providers=["CPUExecutionProvider"]
+                )
+                self.models[model] = (session, tokenizer)
+        return self.models[model]
+
+    def encode (self, model: str, texts: list) -> list:
+        session, tokenizer = self.load(model)
+        encodings = tokenizer.encode_batch(texts)
+        mask = numpy.array([e.attention_mask for e in encodings], dtype=numpy.int64)
+        features = {
+            "input_ids": numpy.array([e.ids for e in encodings], dtype=numpy.int64),
+            "attention_mask": mask,
+            "token_type_ids": numpy.array([e.type_ids for e in encodings], dtype=numpy.int64)
+        }
+        # not every model takes the token types
+        inputs = {i.name: features[i.name] for i in session.get_inputs() if i.name in features}
+        output = session.run(None, inputs)[0]
+        # token embeddings are averaged over the real tokens (mean
+        # pooling), models exported with pooling give one vector already
+        if output.ndim == 3:
+            weights = mask[:, :, None].astype(output.dtype)
+            output = (output * weights).sum(axis=1) / numpy.clip(weights.sum(axis=1), 1e-9, None)
+        # normalized, as sentence transformers do
+        output = output / numpy.clip(numpy.linalg.norm(output, axis=1, keepdims=True), 1e-12, None)
+        return output.tolist()
+
+    async def embed (self, model: str, texts: list) -> list:
+        # the inference runs on a thread, onnxruntime releases the gil
+        async with self.semaphore:
+            return await asyncio.to_thread(self.encode, model, texts)
+
+    async def chat (self, model: str, prompt: str) -> str:
+        raise ValueError("Local only makes embeddings")
+
+
+# available providers, by the name used on config.json
+providers = {
+    "OpenAI": OpenAIProvider,
+    "Ollama": OllamaProvider,
+    "OllamaLegacy": OllamaLegacyProvider,
+    "Local": LocalProvider
+}
+
+
+# the event loop of the process, started on first use
+_loop = None
+_loop_lock = threading.Lock()
+_instances = {}
+
+def get_loop ():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="providers", daemon=True).start()
+    return _loop
+
+def get_provider (name: str) -> Provider:
+    if name not in providers:
+        raise ValueError(f"{name} not available, only: {list(providers.keys())}")
+    with _loop_lock:
+        if name not in _instances:
+            _instances[name] = providers[name]()
+    return _instances[name]
+
+# run a coroutine on the providers loop and wait for its result
+def run (coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+# iterate an async generator from sync code, piece by piece
+def iterate (agen):
+    async def next_piece ():
+        return await anext(agen)
+    try:
+        while True:
+            try:
+                yield run(next_piece())
+            except StopAsyncIteration:
+                return
+    finally:
+        # the consumer stopped early, release the stream
+        run(agen.aclose())
@@ -1,48 +1,132 @@
 import os
+import ast
+import mimetypes
 import importlib
-from modules.extras import generate_id_and_source
+from modules.extras import iter_id_and_source
 
 
-# function to list available files in scrappers
+# every file modules/scrappers/get_<name>.py is a scrapper plugin, it
+# has an iterate(path) generator and declares at module level:
+#   EXTENSIONS = ["pdf"]                 extensions it handles
+#   MIME_TYPES = ["application/pdf"]     mime types it handles
+#   MAGIC = [b"%PDF-"]                   first bytes of the files it handles
+#   COST = "cpu"                         "cpu" or "io", where to run it on ker add
+
+class Scrapper:
+    def __init__ (self, name: str, info: dict):
+        self.name = name
+        self.extensions = [e.lower() for e in info.get("EXTENSIONS", [name[len("get_"):]])]
+        self.mime_types = info.get("MIME_TYPES", [])
+        self.magic = info.get("MAGIC", [])
+        self.cost = info.get("COST", "cpu")
+        self._module = None
+
+    # the module is imported the first time it's used
+    @property
+    def module (self):
+        if self._module is None:
+            self._module = importlib.import_module(f"modules.scrappers.{self.name}")
+        return self._module
+
+
+# read the declarations of a plugin without importing it
+def read_plugin_info (path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    info = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in ("EXTENSIONS", "MIME_TYPES", "MAGIC", "COST"):
+                info[name] = ast.literal_eval(node.value)
+    return info
+
+
+class ScrapperRegistry:
+    def __init__ (self, folder: str):
+        self.by_extension = {}
+        self.by_mime = {}
+        self.scrappers = []
+        # discover the plugins only once
+        for file in sorted(os.listdir(folder)):
+            # every file that starts with get_ and ends in .py
+            if file.startswith("get_") and file.endswith(".py"):
+                scrapper = Scrapper(os.path.splitext(file)[0], read_plugin_info(os.path.join(folder, file)))
+                self.scrappers.append(scrapper)
+                for extension in scrapper.extensions:
+                    self.by_extension[extension] = scrapper
+                for mime in scrapper.mime_types:
+                    self.by_mime[mime] = scrapper
+
+    def extensions (self) -> list:
+        return list(self.by_extension.keys())
+
+    # find the scrapper of a file: by extension, then by the mime type
+    # guessed from the name and finally by the first bytes of the file
+    def for_path (self, path: str):
+        extension = os.path.splitext(path)[1][1:].lower()
+        if extension in self.by_extension:
+            return self.by_extension[extension]
+        mime, _ = mimetypes.guess_type(path)
+        if mime in self.by_mime:
+            return self.by_mime[mime]
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(16)
+        except OSError:
+            return None
+        for scrapper in self.scrappers:
+            if any(head.startswith(magic) for magic in scrapper.magic):
+                return scrapper
+        return None
+
+
+# one registry per process, created on first use
+_registry = None
+
+def get_registry () -> ScrapperRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ScrapperRegistry(os.path.join(os.path.dirname(__file__), "scrappers"))
+    return _registry
+
+# function to list available extensions
 def available_extensions ():
-    available = []
-    # iterate files in scrappers
-    for file in os.listdir(os.environ["PROJECT_PATH"] + "/modules/scrappers"):
-        # every file that ends in .py
-        if file.endswith(".py"):
-            # get the filename without the .py
-            file_name = os.path.splitext(file)[0]
-            # and save it
-            available.append(file_name)
-    # return results
-    return available
-
-# function to get content from files
-def get_content (path, current_dir, collection):
-    # get the file extension
-    extension = path.split('.')[-1]
-    # make it lowercase
-    extension = extension.lower()
-    # copy the file to assets
-    new_path = os.environ["COLLECTIONS_PATH"] + f"{collection}/assets/{path.split('/')[-1]}.{extension}"
+    return get_registry().extensions()
 
-##############################################################
+# where the file is copied in the assets of the collection
+def asset_path (path, collection):
+    # get the file extension
+    extension = path.split('.')[-1].lower()
+    return os.environ["COLLECTIONS_PATH"] + f"{collection}/assets/{path.split('/')[-1]}.{extension}"
 
-    if "get_" + extension in available_extensions():
-        # then import the content scrapper
-        scrapper = importlib.import_module(f"modules.scrappers.get_{extension}")
-        # use it to analyze the file
-        content = scrapper.analyze(path)
-        # add the ids and source to the file
-        content = generate_id_and_source(content, path)
+# initializer of the ker add pool processes. the files are already
+# parsed in parallel there, so the pdf page workers of each one are a
+# share of the same cpu budget instead of multiplying it
+def init_ingest_worker (page_workers: int):
+    os.environ["PDF_WORKERS"] = str(page_workers)
 
-##############################################################
+# function to generate the content of a file chunk by chunk
+def iter_content (path):
+    # find the scrapper for the file
+    scrapper = get_registry().for_path(path)
 
     # if other extension
-    else:
+    if scrapper is None:
         raise ValueError(f"Only accepted {', '.join(available_extensions())} files")
 
-    # if other file was accepted
-    print(f"\n\033[92mfound {len(content)} items in \033[0m{path}")
+    # use it to analyze the file, and add the ids and source
+    # to every chunk as it comes
+    yield from iter_id_and_source(scrapper.module.iterate(path), path)
+
+# function to get content from files, the whole file at once
+def get_content (path, current_dir, collection):
+    # all the chunks of the file
+    content = list(iter_content(path))
+    # where to copy the file in assets
+    return content, asset_path(path, collection)
 
-    return content, new_path
\ No newline at end of file
+# same as get_content but the content is a generator, so the chunks
+# can be stored while the file is still being parsed
+def stream_content (path, current_dir, collection):
+    return iter_content(path), asset_path(path, collection)
@@ -1,8 +1,17 @@
 import fitz  # PyMuPDF for working with PDFs
+import os  # For the parallel settings
 import json  # For saving JSON data
 import re  # For regex operations
+from concurrent.futures import ProcessPoolExecutor  # For page parallel reading
 from collections import Counter, defaultdict  # For counting and grouping
-import tiktoken  # Token counter
+from modules.chunking import split_long_chapters  # Token based splitting
+
+
+# Scrapper plugin declarations
+EXTENSIONS = ["pdf"]
+MIME_TYPES = ["application/pdf"]
+MAGIC = [b"%PDF-"]
+COST = "cpu"  # Layout analysis, runs on the process pool
 
 
 # Step 5: Detect if a string contains a URL
@@ -23,61 +32,6 @@ def filter_and_mark_links(chapters):
     return final
 
 
-# Function to count tokens in a text
-def count_tokens(text):
-    # Load encoder for the model
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-    # Return number of tokens in the encoded text
-    return len(encoding.encode(text))
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    # https://platform.openai.com/tokenizer
-
-
-# Function to split a chapter by token count
-def split_by_tokens(chapter, max_tokens=1000):
-    # Get chapter content
-    content = chapter["content"]
-    # Split by sentence endings
-    sentence_split = re.split(r'(?<=\.)\s+', content)
-
-    # Temporary holders
-    parts = []
-    temp = ""
-    tokenized_parts = []
-
-    # Build token-limited segments
-    for sentence in sentence_split:
-        if count_tokens(temp + " " + sentence) <= max_tokens:
-            temp += " " + sentence
-        else:
-            tokenized_parts.append(temp.strip())
-            temp = sentence
-    if temp.strip():
-        tokenized_parts.append(temp.strip())
-
-    # Create new chapters with updated titles and content
-    result = []
-    for idx, text in enumerate(tokenized_parts):
-        new_chapter = chapter.copy()
-        new_chapter["title"] = f"{chapter['title']} - part {idx + 1}"
-        new_chapter["content"] = text
-        result.append(new_chapter)
-    return result
-
-
-# Function to split long chapters
-def split_long_chapters(chapters, max_tokens=1000):
-    split_result = []
-    for ch in chapters:
-        total_tokens = count_tokens(ch["content"])
-        if total_tokens > max_tokens:
-            parts = split_by_tokens(ch, max_tokens)
-            split_result.extend(parts)
-        else:
-            split_result.append(ch)
-    return split_result
-
-
 # Function to clean and merge chapters
 def process_chapters(chapters):
     # Remove chapters without titles
@@ -121,61 +75,106 @@ def is_valid_title(text):
     return bool(re.search(r'\w', text))
 
 
-# Main function to analyze PDF
-def analyze (pdf_path, json_output=None):
+# Function to extract the text spans of a range of pages in one pass,
+# returns the count of font sizes and the non empty spans in a compact
+# (page_number, size, text) form
+def extract_spans (pdf_path, start=0, stop=None):
     # Open the PDF
     doc = fitz.open(pdf_path)
-    font_sizes = []
-
-    # Collect all font sizes
-    for page in doc:
-        blocks = page.get_text("dict")["blocks"]
+    stop = len(doc) if stop is None else stop
+    # text only, the images data is not needed
+    flags = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+    font_counter = Counter()
+    spans = []
+    for page_number in range(start, stop):
+        # one page at a time, its dict is dropped after reading it
+        blocks = doc[page_number].get_text("dict", flags=flags)["blocks"]
         for block in blocks:
-            if "lines" in block:
-                for line in block["lines"]:
-                    for span in line["spans"]:
-                        font_sizes.append(span["size"])
+            if "lines" not in block:
+                continue
+            for line in block["lines"]:
+                for span in line["spans"]:
+                    # every span counts for the font sizes
+                    font_counter[span["size"]] += 1
+                    text = span["text"].strip()
+                    if text:
+                        spans.append((page_number, span["size"], text))
+    doc.close()
+    return font_counter, spans
+
+
+# Function to extract the spans of a large PDF, the pages are split in
+# ranges read by worker processes that open the document on their own,
+# then the results are merged in page order, same as extract_spans
+def extract_spans_parallel (pdf_path, workers):
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    # a few ranges per worker so the work stays balanced
+    range_size = max(50, -(-total_pages // (workers * 4)))
+    starts = list(range(0, total_pages, range_size))
+    stops = [min(start + range_size, total_pages) for start in starts]
+
+    font_counter = Counter()
+    spans = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map returns the ranges in order
+        for range_counter, range_spans in pool.map(extract_spans, [pdf_path] * len(starts), starts, stops):
+            font_counter.update(range_counter)
+            spans.extend(range_spans)
+    return font_counter, spans
+
+
+# Function to choose how to read the PDF, documents with at least
+# PDF_PARALLEL_PAGES pages are read by PDF_WORKERS processes
+def read_spans (pdf_path, workers=None):
+    if workers is None:
+        workers = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+    min_pages = int(os.environ.get("PDF_PARALLEL_PAGES", 500))
+    if workers > 1:
+        with fitz.open(pdf_path) as doc:
+            if len(doc) >= min_pages:
+                return extract_spans_parallel(pdf_path, workers)
+    return extract_spans(pdf_path)
+
+
+# Function to generate the chapters of a PDF one by one
+def iterate (pdf_path, workers=None):
+    # Collect all font sizes and the text in a single pass
+    font_counter, spans = read_spans(pdf_path, workers)
 
     # Get the most common font size (body text)
-    font_counter = Counter(font_sizes)
     most_common_size = font_counter.most_common(1)[0][0]
 
     # Extract and segment chapters based on font size
     result = []
     current_chapter = None
-
-    for page_number, page in enumerate(doc):
-        blocks = page.get_text("dict")["blocks"]
-        for block in blocks:
-            if "lines" not in block:
-                continue
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    if not text:
-                        continue
-                    size = span["size"]
-
-                    # If font is larger than body text, it's a title
-                    if size > most_common_size:
-                        if current_chapter:
-                            current_chapter["pages"][1] = page_number
-                            result.append(current_chapter)
-
-                        ntitle = int(round(size - most_common_size))
-                        current_chapter = {
-                            "title": text,
-                            "content": "",
-                            "ntitle": ntitle,
-                            "pages": [page_number, page_number]
-                        }
-                    else:
-                        # Add content to current chapter
-                        if current_chapter:
-                            current_chapter["content"] += text + " "
+    # content of the current chapter, joined when it's closed
+    content_parts = []
+
+    for page_number, size, text in spans:
+        # If font is larger than body text, it's a title
+        if size > most_common_size:
+            if current_chapter:
+                current_chapter["pages"][1] = page_number
+                current_chapter["content"] = "".join(content_parts)
+                result.append(current_chapter)
+
+            ntitle = int(round(size - most_common_size))
+            current_chapter = {
+                "title": text,
+                "content": "",
+                "ntitle": ntitle,
+                "pages": [page_number, page_number]
+            }
+            content_parts = []
+        else:
+            # Add content to current chapter
+            if current_chapter:
+                content_parts.append(text + " ")
 
     # Add the last chapter
     if current_chapter:
+        current_chapter["content"] = "".join(content_parts)
         result.append(current_chapter)
 
     # Remove invalid chapters
@@ -222,11 +221,16 @@ def analyze (pdf_path, json_output=None):
     # Further processing: clean and merge
     final_chapters = process_chapters(final_chapters)
 
-    # Split large chapters
-    final_chapters = split_long_chapters(final_chapters, max_tokens=800)
+    for chapter in final_chapters:
+        # Split large chapters
+        parts = split_long_chapters([chapter], max_tokens=800)
+        # Also check links and remove trash chapters
+        yield from filter_and_mark_links(parts)
+
 
-    # Also check links and remove trash chapters
-    final_chapters = filter_and_mark_links(final_chapters)
+# Main function to analyze PDF
+def analyze (pdf_path, json_output=None, workers=None):
+    final_chapters = list(iterate(pdf_path, workers))
 
     # Save as JSON if it was required
     if json_output:
@@ -2,9 +2,16 @@ import json
 import re
 from pptx import Presentation
 
-def analyze (pptx_path, json_output_path=None):
+
+# Declaraciones del plugin de scrapper
+EXTENSIONS = ["pptx"]
+MIME_TYPES = ["application/vnd.openxmlformats-officedocument.presentationml.presentation"]
+MAGIC = []  # Es un zip, igual que docx y xlsx, no se puede distinguir
+COST = "cpu"  # Lectura del XML de cada diapositiva
+
+def iterate (pptx_path):
+    # genera las diapositivas una por una
     prs = Presentation(pptx_path)
-    data = []
 
     for i, slide in enumerate(prs.slides):
         title = ''
@@ -44,7 +51,11 @@ def analyze (pptx_path, json_output_path=None):
             "links": has_links,
             "pages": i + 1
         }
-        data.append(slide_data)
+        yield slide_data
+
+
+def analyze (pptx_path, json_output_path=None):
+    data = list(iterate(pptx_path))
 
     # Guardar en archivo JSON if it was required
     if json_output_path:
@@ -54,5 +65,6 @@ def analyze (pptx_path, json_output_path=None):
     return data
 
 
-analyze("press.pptx", "resultado.json")
+# Ejemplo de uso
+# analyze("press.pptx", "resultado.json")
 # pip install python-pptx
\ No newline at end of file